@@ -0,0 +1,80 @@
+#
+# Micro-benchmark of the dispatch path against the collectd.py stub
+#
+# Compares the per-poll CPU cost of building one collectd.Values per metric
+# (with its type instance formatted every time) against the Snapshot and
+# Dispatcher path with cached type instance names.
+#
+#   python benchmarks/bench_dispatch.py [members] [polls]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import collectd
+from mongodb_core import Dispatcher, NameCache, Snapshot
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+MEMBER_METRICS = ['uptime', 'state', 'health', 'optime_date', 'last_heartbeat', 'last_heartbeat_recv', 'ping_ms']
+
+
+def members(count):
+    return [('host%d' % i, str(27017 + i)) for i in range(count)]
+
+
+def poll_before(hosts):
+    for host, port in hosts:
+        n = "{0}-{1}".format(host, port)
+        for metric in MEMBER_METRICS:
+            v = collectd.Values()
+            v.plugin = 'mongodb_replset'
+            v.plugin_instance = 'rs0'
+            v.type = 'member'
+            v.type_instance = '{0}-{1}'.format(n, metric)
+            v.values = [1, ]
+            v.dispatch()
+
+
+def poll_after(hosts, name, dispatcher):
+    values = []
+    for host, port in hosts:
+        n = name('{0}-{1}', host, port)
+        for metric in MEMBER_METRICS:
+            values.append(('mongodb_replset', 'rs0', 'member', name('{0}-{1}', n, metric), 1))
+    dispatcher.flush(Snapshot(time.time(), values))
+
+
+def measure(func, polls, *args):
+    func(*args)
+    start = cpu_time()
+    for i in range(polls):
+        func(*args)
+    return (cpu_time() - start) / polls
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    hosts = members(count)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        before = measure(poll_before, polls, hosts)
+        after = measure(poll_after, polls, hosts, NameCache(), Dispatcher())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print('%d values per poll, %d polls' % (count * len(MEMBER_METRICS), polls))
+    print('per-metric Values: %8.1f us/poll' % (before * 1e6))
+    print('batched dispatch:  %8.1f us/poll' % (after * 1e6))
+    print('saved:             %7.1f%%' % ((before - after) * 100.0 / before))
+
+
+if __name__ == '__main__':
+    main()
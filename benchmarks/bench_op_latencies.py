@@ -0,0 +1,74 @@
+#
+# Accuracy and CPU cost of the opLatencies percentiles
+#
+# Checks the percentiles computed from sparse histograms, where the server
+# left most buckets out, against the buckets the operations fell in, then
+# measures the per-reply CPU cost of LatencyHistograms.update() on the
+# fixture. Exits with status 1 when a percentile is wrong.
+#
+#   python benchmarks/bench_op_latencies.py [updates]
+#
+
+import sys
+import time
+
+import harness
+import fixtures
+import mongodb_core
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+# (name, buckets of the interval as {lower bound: count},
+#  expected (low, high) of p50, p95, p99 and max)
+SPARSE = [
+    ('one slow read', {16: 1000, 1048576: 1}, [(16, 32), (16, 32), (16, 32), (1572864, 1572864)]),
+    ('slow tail', {16: 900, 2048: 90, 6144: 10}, [(16, 32), (2048, 3072), (2048, 3072), (8192, 8192)]),
+    ('last bucket', {1099511627776: 1}, [(1099511627776, 2199023255552)] * 3 + [(2199023255552, 2199023255552)]),
+]
+
+
+def reply(buckets):
+    return {'reads': {'ops': sum(buckets.values()), 'latency': 0,
+                      'histogram': [{'micros': b, 'count': c} for b, c in sorted(buckets.items())]}}
+
+
+def check():
+    failed = []
+    for name, buckets, expected in SPARSE:
+        h = mongodb_core.LatencyHistograms()
+        h.update(reply({}))
+        latencies = dict(h.update(reply(buckets)))['reads'][:-1]
+        for (metric, value), (low, high) in zip(latencies, expected):
+            if not low <= value <= high:
+                failed.append('%s: %s %.1f not in [%d, %d]' % (name, metric, value, low, high))
+    return failed
+
+
+def measure(updates):
+    # replies of a server whose counters grow by the fixture every interval
+    h = mongodb_core.LatencyHistograms()
+    replies = []
+    for i in range(updates + 1):
+        replies.append(fixtures.op_latencies(histograms=True))
+        for section in replies[-1].values():
+            section['ops'] *= i + 1
+            for bucket in section['histogram']:
+                bucket['count'] *= i + 1
+    h.update(replies[0])
+    start = cpu_time()
+    for r in replies[1:]:
+        h.update(r)
+    return (cpu_time() - start) / updates
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    failed = check()
+    print('%8.1f us/update, sparse histograms %s' % (measure(updates) * 1e6, 'wrong' if failed else 'ok'))
+    for line in failed:
+        print('WRONG %s' % line)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#
+# Per-poll CPU cost of do_replset_get_status on a large replica set
+#
+# Compares polls where the member topology is parsed again every time with
+# polls served from the topology cache.
+#
+#   python benchmarks/bench_replset_status.py [members] [polls]
+#
+
+import sys
+import time
+
+import fixtures
+import harness
+from mongodb_core import Server
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+class Database(object):
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    def command(self, *args, **kwargs):
+        return self.reply
+
+
+def measure(plugin, db, polls, cached):
+    plugin.do_replset_get_status(db)
+    start = cpu_time()
+    for i in range(polls):
+        if not cached:
+            plugin.server.topology.key = None
+        plugin.values = []
+        plugin.do_replset_get_status(db)
+    return (cpu_time() - start) / polls
+
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    mongodb, mongodb_replset = harness.load_plugins()
+    plugin = mongodb_replset.MongoDBReplSet()
+    plugin.server = Server(None, 'localhost', 27017)
+    db = Database(fixtures.repl_set_get_status(members))
+
+    uncached = measure(plugin, db, polls, False)
+    cached = measure(plugin, db, polls, True)
+
+    print('%d members, %d values per poll, %d polls' % (members, len(plugin.values), polls))
+    print('topology parsed every poll: %8.1f us/poll' % (uncached * 1e6))
+    print('topology cache:             %8.1f us/poll' % (cached * 1e6))
+
+
+if __name__ == '__main__':
+    main()
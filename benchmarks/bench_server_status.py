@@ -0,0 +1,70 @@
+#
+# Size and decode cost of the serverStatus reply, full versus projected
+#
+# The projected reply is the full fixture without the sections the
+# plugin's serverStatus command excludes once it has seen a first reply.
+# The wired_tiger collector's reply, projected to the wiredTiger section,
+# is decoded in full versus only the subtrees the collector reads.
+#
+#   python benchmarks/bench_server_status.py [decodes]
+#
+
+import sys
+import time
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
+import fixtures
+import harness
+import mongodb_core
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def project(reply, projection):
+    return dict((k, v) for k, v in reply.items() if k not in projection.excluded)
+
+
+def measure(decode, data, decodes):
+    decode(data)
+    start = cpu_time()
+    for i in range(decodes):
+        decode(data)
+    return (cpu_time() - start) / decodes
+
+
+def full_decode(data):
+    return BSON(data).decode()
+
+
+def main():
+    decodes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    mongodb, mongodb_replset = harness.load_plugins()
+    full = fixtures.server_status()
+
+    target = mongodb.MongoDB()
+    target.compile_metrics()
+    projection = target.server_status
+    projection.learn(project(full, projection))
+
+    before = BSON.encode(full)
+    after = BSON.encode(project(full, projection))
+
+    wired_tiger = target.wired_tiger_status
+    wired_tiger.learn(project(full, wired_tiger))
+    sections = BSON.encode(project(full, wired_tiger))
+    stats = mongodb_core.PollStats()
+
+    def selective_decode(data):
+        return stats.decode('serverStatus', RawBSONDocument(data), mongodb.WIRED_TIGER_PATHS)
+
+    print('excluded sections: %s' % ', '.join(sorted(projection.excluded)))
+    print('full reply:        %7d bytes %8.1f us/decode' % (len(before), measure(full_decode, before, decodes) * 1e6))
+    print('projected reply:   %7d bytes %8.1f us/decode' % (len(after), measure(full_decode, after, decodes) * 1e6))
+    print('wiredTiger reply:  %7d bytes %8.1f us/decode' % (len(sections), measure(full_decode, sections, decodes) * 1e6))
+    print('wiredTiger read:   %7d bytes %8.1f us/decode' % (len(sections), measure(selective_decode, sections, decodes) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
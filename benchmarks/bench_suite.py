@@ -0,0 +1,212 @@
+#
+# Offline benchmark suite of the mongodb and mongodb_replset plugins
+#
+# Runs both plugins end to end, from the commands they send to the values
+# they dispatch, against a fake MongoClient replaying recorded replies at
+# several scales, on a virtual clock advancing by one poll interval per
+# poll. Reports the per-poll wall time, CPU time, peak allocated memory
+# (tracemalloc, Python 3 only), dispatched values and commands sent, and
+# exits with status 1 when a result regressed past the stored baselines.
+#
+#   python benchmarks/bench_suite.py [--polls N] [--update] [scenario ...]
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+
+import harness
+import collectd
+import fake_client
+import fixtures
+import mongodb_core
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+wall_time = timeit.default_timer
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+POLL_INTERVAL = 10.0
+DEFAULT_POLLS = 30
+DEFAULT_TOLERANCE = 0.3
+
+# name, plugin, Replies arguments, target attributes
+SCENARIOS = [
+    ('mongodb-10-collections', 'mongodb', dict(collections=10), {}),
+    ('mongodb-50k-collections', 'mongodb', dict(collections=50000), {}),
+    ('mongodb-500-databases', 'mongodb', dict(tenants=500), {'databases.discover': True}),
+    ('mongodb-50k-collections-indexes', 'mongodb', dict(collections=50000), {'schedule.intervals.index_stats': 0}),
+    ('mongodb-1k-collections-indexes', 'mongodb', dict(collections=1000), {'schedule.intervals.index_stats': 0}),
+    ('replset-1-member', 'mongodb_replset', dict(members=1), {}),
+    ('replset-50-members', 'mongodb_replset', dict(members=50), {}),
+    ('replset-50-members-suppressed', 'mongodb_replset', dict(members=50), {'dispatcher.changes.enabled': True}),
+    ('replset-50-members-lag-matrix', 'mongodb_replset', dict(members=50), {'lags.enabled': True}),
+]
+
+# polls run before measuring the steady state of a scenario, at least
+# --warmup: the index rates of 1000 collections, visited 100 per poll, are
+# all known from the 11th poll on
+WARMUP = {'mongodb-1k-collections-indexes': 10}
+
+# results compared to the baselines; counts must not grow past what the
+# periodic work (listings, oplog stats...) falling in or out of the
+# measured polls changes in their per-poll averages
+TIMES = ['cpu_us', 'alloc_kb']
+COUNTS = ['dispatches', 'commands']
+COUNT_SLACK = 0.1
+
+
+class DispatchCounter(object):
+
+    def __init__(self):
+        self.count = 0
+        counter = self
+
+        def dispatch(self, **kwargs):
+            counter.count += 1
+
+        collectd.Values.dispatch = dispatch
+
+
+def configure(t, settings):
+    for path, value in settings.items():
+        obj = t
+        names = path.split('.')
+        for name in names[:-1]:
+            obj = obj[name] if isinstance(obj, dict) else getattr(obj, name)
+        if isinstance(obj, dict):
+            obj[names[-1]] = value
+        else:
+            setattr(obj, names[-1], value)
+
+
+def target(plugins, plugin, settings):
+    """Returns the poll and shutdown functions of a configured plugin"""
+    mongodb, mongodb_replset = plugins
+    if plugin == 'mongodb':
+        t = mongodb.MongoDB()
+        t.mongo_db = ['admin', 'app']
+        configure(t, settings)
+        t.init()
+
+        def poll():
+            t.get_db_and_collection_stats()
+            t.flush()
+        return poll, t.shutdown
+    t = mongodb_replset.MongoDBReplSet()
+    configure(t, settings)
+    t.init()
+    return t.do_status, t.shutdown
+
+
+def run(plugins, plugin, replies, settings, polls, warmup):
+    commands = fake_client.install(replies)
+    clock = harness.install_clock(fixtures.EPOCH, [plugins[0], plugins[1], mongodb_core])
+    dispatches = DispatchCounter()
+    poll, shutdown = target(plugins, plugin, settings)
+    try:
+        for i in range(warmup):
+            clock.advance(POLL_INTERVAL)
+            poll()
+        sent = sum(commands.values())
+        dispatches.count = 0
+        wall = cpu = 0.0
+        for i in range(polls):
+            clock.advance(POLL_INTERVAL)
+            start_wall, start_cpu = wall_time(), cpu_time()
+            poll()
+            cpu += cpu_time() - start_cpu
+            wall += wall_time() - start_wall
+        result = {
+            'wall_us': wall / polls * 1e6,
+            'cpu_us': cpu / polls * 1e6,
+            'dispatches': float(dispatches.count) / polls,
+            'commands': float(sum(commands.values()) - sent) / polls,
+            'alloc_kb': None,
+        }
+        if tracemalloc is not None:
+            peak = 0
+            for i in range(polls):
+                clock.advance(POLL_INTERVAL)
+                tracemalloc.start()
+                poll()
+                peak += tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result['alloc_kb'] = peak / 1024.0 / polls
+        return result
+    finally:
+        shutdown()
+
+
+def regressions(name, result, baseline, tolerance):
+    found = []
+    for key in TIMES:
+        if result[key] is not None and baseline.get(key) is not None and result[key] > baseline[key] * (1 + tolerance):
+            found.append('%s: %s %.1f > baseline %.1f' % (name, key, result[key], baseline[key]))
+    for key in COUNTS:
+        if key in baseline and round(result[key], 2) > baseline[key] + COUNT_SLACK:
+            found.append('%s: %s %.2f > baseline %.2f' % (name, key, result[key], baseline[key]))
+    return found
+
+
+def fmt(value, width):
+    return ('%*.1f' % (width, value)) if value is not None else ('%*s' % (width, 'n/a'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite of the MongoDB plugins')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default')
+    parser.add_argument('--polls', type=int, default=DEFAULT_POLLS, help='measured polls per scenario')
+    parser.add_argument('--warmup', type=int, default=1, help='polls run before measuring')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed relative increase of cpu_us and alloc_kb over the baselines')
+    parser.add_argument('--baselines', default=BASELINES, help='baselines file')
+    parser.add_argument('--update', action='store_true', help='store the results as the new baselines')
+    args = parser.parse_args()
+
+    plugins = harness.load_plugins()
+    scenarios = [s for s in SCENARIOS if not args.scenarios or s[0] in args.scenarios]
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    # timings only compare between runs of the same interpreter
+    python = 'python%d' % sys.version_info[0]
+    stored = baselines.setdefault(python, {})
+
+    print('%-32s %10s %10s %10s %11s %9s' % ('scenario', 'wall us', 'cpu us', 'alloc KB', 'dispatches', 'commands'))
+    results = {}
+    failed = []
+    for name, plugin, kwargs, settings in scenarios:
+        warmup = max(args.warmup, WARMUP.get(name, 0))
+        result = results[name] = run(plugins, plugin, fake_client.Replies(**kwargs), settings, args.polls, warmup)
+        print('%-32s %s %s %s %s %s' % (name, fmt(result['wall_us'], 10), fmt(result['cpu_us'], 10),
+                                         fmt(result['alloc_kb'], 10), fmt(result['dispatches'], 11),
+                                         fmt(result['commands'], 9)))
+        if name in stored:
+            failed.extend(regressions(name, result, stored[name], args.tolerance))
+
+    if args.update:
+        for name, result in results.items():
+            stored[name] = dict((k, round(v, 2) if v is not None else None) for k, v in result.items())
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print('baselines written to %s' % args.baselines)
+        return 0
+
+    for line in failed:
+        print('REGRESSION %s' % line)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#
+# A MongoClient replaying the fixtures, for running the plugins offline
+#
+# Replies are kept BSON encoded and decoded on every command, as pymongo
+# does with what it reads from the socket, so that a poll costs what it
+# would against a server minus the network round trips.
+#
+
+from collections import defaultdict
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import OperationFailure
+
+import fixtures
+
+
+class Replies(object):
+    """The server a scenario polls: its replica set, databases and collections"""
+
+    def __init__(self, members=3, collections=10, tenants=0):
+        # the admin database has system collections only; tenant databases
+        # have 10 collections each
+        self.collections = {'admin': fixtures.collection_names(0), 'app': fixtures.collection_names(collections)}
+        for i in range(tenants):
+            self.collections['tenant%04d' % i] = fixtures.collection_names(10)
+        self.namespaces = set((db, name) for db, names in self.collections.items() for name in names)
+        self.encoded = {}
+        self.encode('replSetGetStatus', fixtures.repl_set_get_status(members, min(1, members - 1)))
+        self.encode('collStats', fixtures.oplog_stats())
+        self.encode('collstats', fixtures.coll_stats('app.collection'))
+        self.encode('ping', {'ok': 1.0})
+        self.encode('aggregate', fixtures.current_op_summary())
+        self.encode('indexStats', fixtures.index_stats('app.collection'))
+        self.encode('oplog_head', fixtures.oplog_entry(86400))
+        self.encode('oplog_tail', fixtures.oplog_entry(2))
+        for name, names in self.collections.items():
+            self.encode('dbstats.' + name, fixtures.db_stats(name, len(names)))
+        self.encode('listDatabases', fixtures.list_databases(sorted(self.collections) + ['config', 'local']))
+        self.server_status = fixtures.server_status()
+        self.op_latencies = fixtures.op_latencies(histograms=True)
+
+    def encode(self, name, doc):
+        self.encoded[name] = BSON.encode(doc)
+
+    def reply(self, name, codec_options=None):
+        if codec_options is not None and codec_options.document_class is RawBSONDocument:
+            return RawBSONDocument(self.encoded[name])
+        return BSON(self.encoded[name]).decode()
+
+    def server_status_reply(self, command, codec_options=None):
+        # the sections excluded by the projection are left out by the server
+        excluded = tuple(sorted(k for k, v in command.items() if k != 'serverStatus' and not v))
+        options = command.get('opLatencies')
+        histograms = isinstance(options, dict) and bool(options.get('histograms'))
+        key = 'serverStatus' + '.'.join(('',) + excluded) + ('.histograms' if histograms else '')
+        if key not in self.encoded:
+            doc = dict((k, v) for k, v in self.server_status.items() if k not in excluded)
+            if histograms:
+                doc['opLatencies'] = self.op_latencies
+            self.encode(key, doc)
+        return self.reply(key, codec_options)
+
+
+class Cursor(list):
+    pass
+
+
+class Collection(object):
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def find(self, sort=None, limit=0, **kwargs):
+        self.db.client.count('find')
+        if self.name != 'oplog.rs':
+            return Cursor()
+        direction = sort[0][1] if sort else 1
+        return Cursor([self.db.replies.reply('oplog_head' if direction > 0 else 'oplog_tail')])
+
+
+class Database(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.replies = client.replies
+        self.name = name
+
+    def authenticate(self, user, password):
+        self.client.count('saslStart')
+        return True
+
+    def command(self, command, value=1, codec_options=None, **kwargs):
+        name = command if isinstance(command, str) else next(iter(command))
+        self.client.count(name)
+        replies = self.replies
+        if name == 'serverStatus':
+            return replies.server_status_reply(command, codec_options)
+        if name == 'dbstats':
+            return replies.reply('dbstats.' + self.name, codec_options)
+        if name == 'aggregate' and value != 1:
+            # collection aggregations are the $indexStats of index_stats
+            if (self.name, value) not in replies.namespaces:
+                raise OperationFailure('Collection [%s.%s] not found.' % (self.name, value))
+            return replies.reply('indexStats', codec_options)
+        if name == 'collstats':
+            if (self.name, value) not in replies.namespaces:
+                raise OperationFailure('Collection [%s.%s] not found.' % (self.name, value))
+            return replies.reply('collstats', codec_options)
+        if name in replies.encoded:
+            return replies.reply(name, codec_options)
+        raise OperationFailure('no such command: %s' % name)
+
+    def collection_names(self):
+        self.client.count('listCollections')
+        return list(self.replies.collections.get(self.name, ()))
+
+    def __getitem__(self, name):
+        return Collection(self, name)
+
+
+class FakeMongoClient(object):
+
+    def __init__(self, replies, commands):
+        self.replies = replies
+        self.commands = commands
+
+    def count(self, name):
+        self.commands[name] += 1
+
+    def __getitem__(self, name):
+        return Database(self, name)
+
+    def close(self):
+        pass
+
+
+def install(replies):
+    """Makes the plugins connect to `replies`; returns the per-command call counts"""
+    import mongodb_core
+    commands = defaultdict(int)
+    mongodb_core.MongoClient = lambda *args, **kwargs: FakeMongoClient(replies, commands)
+    return commands
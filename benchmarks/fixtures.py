@@ -0,0 +1,353 @@
+#
+# Server responses used by the benchmarks
+#
+# The documents have the shape and roughly the size of what a MongoDB 4.x
+# replica set member running WiredTiger returns; the values are
+# deterministic so that runs can be compared with each other.
+#
+
+from datetime import datetime, timedelta
+
+from bson.int64 import Int64
+from bson.timestamp import Timestamp
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+EPOCH = 1767268800
+
+# number of statistics per serverStatus.wiredTiger section, as in 4.x
+WIRED_TIGER_SECTIONS = [
+    ('LSM', 20), ('async', 15), ('block-manager', 15), ('cache', 110),
+    ('capacity', 10), ('connection', 20), ('cursor', 45), ('data-handle', 12),
+    ('lock', 30), ('log', 60), ('perf', 30), ('reconciliation', 30),
+    ('session', 40), ('thread-state', 3), ('thread-yield', 20),
+    ('transaction', 50), ('uri', 0),
+]
+
+WIRED_TIGER_CACHE = {
+    'maximum bytes configured': 8 << 30,
+    'bytes currently in the cache': 6 << 30,
+    'tracked dirty bytes in the cache': 300 << 20,
+    'bytes read into cache': 900 << 30,
+    'bytes written from cache': 700 << 30,
+    'pages read into cache': 50000000,
+    'pages written from cache': 40000000,
+    'unmodified pages evicted': 30000000,
+    'modified pages evicted': 9000000,
+    'pages evicted by application threads': 12000,
+    'eviction worker thread evicting pages': 25000000,
+}
+
+COMMANDS = [
+    'aggregate', 'buildInfo', 'collStats', 'count', 'createIndexes', 'dbStats',
+    'delete', 'distinct', 'drop', 'endSessions', 'find', 'findAndModify',
+    'getMore', 'getParameter', 'insert', 'isMaster', 'killCursors',
+    'listCollections', 'listDatabases', 'listIndexes', 'ping',
+    'replSetGetStatus', 'replSetHeartbeat', 'replSetUpdatePosition',
+    'saslContinue', 'saslStart', 'serverStatus', 'update', 'whatsmyuri',
+] + ['command%03d' % i for i in range(170)]
+
+
+def ts(seconds_ago=0):
+    return Timestamp(EPOCH - seconds_ago, 1)
+
+
+def counters(names, base=1000):
+    return dict((name, base * (i + 1)) for i, name in enumerate(names))
+
+
+def wired_tiger():
+    wt = {}
+    for section, count in WIRED_TIGER_SECTIONS:
+        wt[section] = dict(('%s statistic number %d' % (section, i), i * 1024) for i in range(count))
+    wt['uri'] = 'statistics:'
+    wt['cache'].update(WIRED_TIGER_CACHE)
+    wt['block-manager'].update({'blocks read': 900000, 'blocks written': 800000, 'bytes read': 9 << 30, 'bytes written': 8 << 30})
+    wt['transaction'].update({'transaction checkpoints': 5000, 'transaction checkpoint currently running': 0,
+                              'transaction checkpoint most recent time (msecs)': 1200,
+                              'transaction checkpoint total time (msecs)': 6000000})
+    wt['concurrentTransactions'] = {
+        'write': {'out': 3, 'available': 125, 'totalTickets': 128},
+        'read': {'out': 7, 'available': 121, 'totalTickets': 128},
+    }
+    return wt
+
+
+def lock_stats():
+    modes = {'r': 100000, 'w': 20000, 'R': 30, 'W': 10}
+    return {
+        'acquireCount': dict(modes),
+        'acquireWaitCount': {'r': 12, 'w': 3},
+        'timeAcquiringMicros': {'r': 5000, 'w': 900},
+    }
+
+
+def metrics():
+    return {
+        'commands': dict((name, {'failed': i, 'total': 1000 * i}) for i, name in enumerate(COMMANDS)),
+        'cursor': {'timedOut': 4, 'open': {'noTimeout': 0, 'pinned': 2, 'total': 12}},
+        'document': counters(['deleted', 'inserted', 'returned', 'updated']),
+        'getLastError': {'wtime': {'num': 10, 'totalMillis': 50}, 'wtimeouts': 0},
+        'operation': counters(['scanAndOrder', 'writeConflicts']),
+        'queryExecutor': counters(['scanned', 'scannedObjects']),
+        'record': {'moves': 0},
+        'repl': {
+            'executor': {
+                'pool': {'inProgressCount': 0},
+                'queues': {'networkInProgress': 0, 'sleepers': 3},
+                'unsignaledEvents': 0,
+                'shuttingDown': False,
+                'networkInterface': 'DEBUG build with 2 connections',
+            },
+            'apply': {'attemptsToBecomeSecondary': 1, 'batchSize': 5000, 'batches': {'num': 800, 'totalMillis': 90}, 'ops': 60000},
+            'buffer': {'count': 0, 'maxSizeBytes': 268435456, 'sizeBytes': 0},
+            'initialSync': {'completed': 1, 'failedAttempts': 0, 'failures': 0},
+            'network': {'bytes': 9 << 20, 'getmores': {'num': 9000, 'totalMillis': 800000}, 'ops': 60000, 'readersCreated': 4},
+            'preload': {'docs': {'num': 0, 'totalMillis': 0}, 'indexes': {'num': 0, 'totalMillis': 0}},
+        },
+        'storage': {'freelist': {'search': {'bucketExhausted': 0, 'requests': 0, 'scanned': 0}}},
+        'ttl': {'deletedDocuments': 5000, 'passes': 900},
+    }
+
+
+def latency_histogram(ops, latency):
+    # power of two buckets around the mean latency, all of them server
+    # buckets, listed by their lower bound
+    mean = latency // ops
+    buckets = [(mean // 4, 0.1), (mean // 2, 0.2), (mean, 0.4), (mean * 2, 0.2), (mean * 8, 0.1)]
+    return [{'micros': Int64(1 << (micros.bit_length() - 1)), 'count': Int64(int(ops * share))}
+            for micros, share in buckets]
+
+
+def op_latencies(histograms=False):
+    section = {
+        'reads': {'latency': 90000000, 'ops': 800000},
+        'writes': {'latency': 30000000, 'ops': 200000},
+        'commands': {'latency': 60000000, 'ops': 900000},
+        'transactions': {'latency': 0, 'ops': 0},
+    }
+    if histograms:
+        for stats in section.values():
+            stats['histogram'] = latency_histogram(stats['ops'], stats['latency']) if stats['ops'] else []
+    return section
+
+
+def current_op_summary():
+    # what the current_op collector's $currentOp aggregation returns
+    return {'cursor': {'id': Int64(0), 'ns': 'admin.$cmd.aggregate', 'firstBatch': [{
+        'total': [{'_id': None, 'active': 42, 'waiting_for_lock': 3, 'waiting_for_flow_control': 1}],
+        'op': [{'_id': 'query', 'count': 20}, {'_id': 'getmore', 'count': 12}, {'_id': 'command', 'count': 8},
+               {'_id': 'update', 'count': 2}],
+        'database': [{'_id': 'app', 'count': 30}, {'_id': 'local', 'count': 10}, {'_id': '', 'count': 2}],
+        'running': [{'_id': 0, 'count': 38}, {'_id': 1, 'count': 3}, {'_id': 600, 'count': 1}],
+    }]}, 'ok': 1.0}
+
+
+def index_stats(ns, count=8):
+    # what the index_stats collector's $indexStats aggregation returns; the
+    # last quarter of the indexes were never used
+    since = NOW - timedelta(days=30)
+    names = ['_id_'] + ['field%d_1' % i for i in range(1, count)]
+    return {'cursor': {'id': Int64(0), 'ns': ns, 'firstBatch': [
+        {'name': name, 'accesses': {'ops': Int64(1000000 // (i + 1) if i < count * 3 // 4 else 0), 'since': since}}
+        for i, name in enumerate(names)
+    ]}, 'ok': 1.0}
+
+
+def server_status():
+    ops = counters(['insert', 'query', 'update', 'delete', 'getmore', 'command'])
+    return {
+        'host': 'node1.example.com:27017',
+        'version': '4.2.24',
+        'process': 'mongod',
+        'pid': 4242,
+        'uptime': 864000.0,
+        'uptimeMillis': 864000000,
+        'uptimeEstimate': 864000,
+        'localTime': NOW,
+        'asserts': counters(['regular', 'warning', 'msg', 'user', 'rollovers']),
+        'connections': {'current': 120, 'available': 51080, 'totalCreated': 98000, 'active': 14},
+        'electionMetrics': dict((name, {'called': 1, 'successful': 1}) for name in
+                                ['stepUpCmd', 'priorityTakeover', 'catchUpTakeover', 'electionTimeout', 'freezeTimeout']),
+        'extra_info': {'note': 'fields vary by platform', 'page_faults': 420, 'user_time_us': 9 << 30, 'system_time_us': 2 << 30},
+        'flowControl': {'enabled': True, 'targetRateLimit': 1000000000, 'timeAcquiringMicros': 900, 'locksPerOp': 0,
+                        'sustainerRate': 0, 'isLagged': False, 'isLaggedCount': 0, 'isLaggedTimeMicros': 0},
+        'globalLock': {
+            'totalTime': 864000000000,
+            'currentQueue': {'total': 0, 'readers': 0, 'writers': 0},
+            'activeClients': {'total': 30, 'readers': 2, 'writers': 1},
+        },
+        'locks': dict((name, lock_stats()) for name in
+                      ['ParallelBatchWriterMode', 'ReplicationStateTransition', 'Global', 'Database', 'Collection', 'Mutex', 'oplog']),
+        'logicalSessionRecordCache': counters(['activeSessionsCount', 'sessionsCollectionJobCount', 'lastSessionsCollectionJobDurationMillis',
+                                               'lastSessionsCollectionJobEntriesRefreshed', 'transactionReaperJobCount']),
+        'network': {'bytesIn': 9 << 30, 'bytesOut': 30 << 30, 'physicalBytesIn': 9 << 30, 'physicalBytesOut': 30 << 30,
+                    'numRequests': 90000000, 'compression': {'snappy': {'compressor': {'bytesIn': 1, 'bytesOut': 1},
+                                                                        'decompressor': {'bytesIn': 1, 'bytesOut': 1}}},
+                    'serviceExecutorTaskStats': {'executor': 'passthrough', 'threadsRunning': 120}},
+        'opLatencies': op_latencies(),
+        'opReadConcernCounters': counters(['available', 'linearizable', 'local', 'majority', 'snapshot', 'none']),
+        'opcounters': ops,
+        'opcountersRepl': dict(ops),
+        'oplogTruncation': {'totalTimeProcessingMicros': 4000, 'processingMethod': 'scanning', 'totalTimeTruncatingMicros': 9000, 'truncateCount': 90},
+        'repl': {
+            'hosts': ['node1.example.com:27017', 'node2.example.com:27017', 'node3.example.com:27017'],
+            'setName': 'rs0',
+            'setVersion': 3,
+            'ismaster': True,
+            'secondary': False,
+            'primary': 'node1.example.com:27017',
+            'me': 'node1.example.com:27017',
+            'electionId': 'ffffffff0000000000000005',
+            'lastWrite': {'opTime': {'ts': ts(2), 't': 5}, 'lastWriteDate': NOW - timedelta(seconds=2),
+                          'majorityOpTime': {'ts': ts(3), 't': 5}, 'majorityWriteDate': NOW - timedelta(seconds=3)},
+            'rbid': 1,
+        },
+        'security': {'authentication': {'mechanisms': {'SCRAM-SHA-256': {'authenticate': {'received': 9000, 'successful': 9000}}}}},
+        'storageEngine': {'name': 'wiredTiger', 'supportsCommittedReads': True, 'oldestRequiredTimestampForCrashRecovery': ts(60),
+                          'supportsPendingDrops': True, 'dropPendingIdents': 0, 'supportsSnapshotReadConcern': True,
+                          'readOnly': False, 'persistent': True, 'backupCursorOpen': False},
+        'tcmalloc': {
+            'generic': {'current_allocated_bytes': 5 << 30, 'heap_size': 6 << 30},
+            'tcmalloc': dict(('tcmalloc statistic number %d' % i, i << 20) for i in range(20)),
+        },
+        'trafficRecording': {'running': False},
+        'transactions': counters(['retriedCommandsCount', 'retriedStatementsCount', 'transactionsCollectionWriteCount',
+                                  'currentActive', 'currentInactive', 'currentOpen', 'totalAborted', 'totalCommitted',
+                                  'totalStarted', 'totalPrepared', 'totalPreparedThenCommitted', 'totalPreparedThenAborted',
+                                  'currentPrepared']),
+        'transportSecurity': {'1.0': 0, '1.1': 0, '1.2': 9000, '1.3': 0, 'unknown': 0},
+        'twoPhaseCommitCoordinator': {'totalCreated': 0, 'totalStartedTwoPhaseCommit': 0, 'totalAbortedTwoPhaseCommit': 0,
+                                      'totalCommittedTwoPhaseCommit': 0},
+        'wiredTiger': wired_tiger(),
+        'mem': {'bits': 64, 'resident': 7000, 'virtual': 9000, 'supported': True},
+        'metrics': metrics(),
+        'ok': 1.0,
+    }
+
+
+def repl_set_get_status(members=3, self_index=1):
+    rs_members = []
+    for i in range(members):
+        primary = i == 0
+        m = {
+            '_id': i,
+            'name': 'node%d.example.com:27017' % (i + 1),
+            'health': 1.0,
+            'state': 1 if primary else 2,
+            'stateStr': 'PRIMARY' if primary else 'SECONDARY',
+            'uptime': 864000,
+            'optime': {'ts': ts(0 if primary else i % 5), 't': 5},
+            'optimeDurable': {'ts': ts(0 if primary else i % 5), 't': 5},
+            'optimeDate': NOW - timedelta(seconds=0 if primary else i % 5),
+            'optimeDurableDate': NOW - timedelta(seconds=0 if primary else i % 5),
+            'lastHeartbeat': NOW,
+            'lastHeartbeatRecv': NOW,
+            'pingMs': 1 + i % 3,
+            'syncingTo': '' if primary else 'node1.example.com:27017',
+            'syncSourceHost': '' if primary else 'node1.example.com:27017',
+            'syncSourceId': -1 if primary else 0,
+            'infoMessage': '',
+            'configVersion': 3,
+        }
+        if primary:
+            m['electionTime'] = ts(86400)
+            m['electionDate'] = NOW - timedelta(days=1)
+        if i == self_index:
+            m['self'] = True
+            for k in ['lastHeartbeat', 'lastHeartbeatRecv', 'pingMs']:
+                del m[k]
+        rs_members.append(m)
+    return {
+        'set': 'rs0',
+        'date': NOW,
+        'myState': rs_members[self_index]['state'],
+        'term': 5,
+        'syncingTo': 'node1.example.com:27017',
+        'heartbeatIntervalMillis': 2000,
+        'optimes': {
+            'lastCommittedOpTime': {'ts': ts(1), 't': 5},
+            'readConcernMajorityOpTime': {'ts': ts(1), 't': 5},
+            'appliedOpTime': {'ts': ts(0), 't': 5},
+            'durableOpTime': {'ts': ts(0), 't': 5},
+        },
+        'members': rs_members,
+        'ok': 1.0,
+    }
+
+
+def db_stats(name, collections):
+    return {
+        'db': name,
+        'collections': collections,
+        'views': 0,
+        'objects': collections * 1000,
+        'avgObjSize': 512.0,
+        'dataSize': collections * 512000.0,
+        'storageSize': collections * 300000.0,
+        'numExtents': 0,
+        'indexes': collections * 2,
+        'indexSize': collections * 40000.0,
+        'fsUsedSize': 200 << 30,
+        'fsTotalSize': 500 << 30,
+        'ok': 1.0,
+    }
+
+
+def coll_stats(ns):
+    return {
+        'ns': ns,
+        'size': 512000,
+        'count': 1000,
+        'avgObjSize': 512,
+        'storageSize': 300000,
+        'capped': False,
+        'wiredTiger': {
+            'metadata': {'formatVersion': 1},
+            'creationString': 'access_pattern_hint=none,allocation_size=4KB,app_metadata=(formatVersion=1)',
+            'type': 'file',
+            'uri': 'statistics:table:collection-%s' % ns,
+            'block-manager': counters(['allocations requiring file extension', 'blocks allocated', 'blocks freed',
+                                       'bytes read', 'bytes written', 'file size in bytes']),
+            'cache': counters(['bytes currently in the cache', 'bytes read into cache', 'bytes written from cache',
+                               'pages read into cache', 'pages written from cache']),
+            'cursor': counters(['bulk-loaded cursor-insert calls', 'create calls', 'cursor-insert key and value bytes inserted',
+                                'cursor-remove key bytes removed', 'cursor-update value bytes updated', 'insert calls',
+                                'modify calls', 'next calls', 'prev calls', 'remove calls', 'reserve calls',
+                                'reset calls', 'search calls', 'search near calls', 'truncate calls', 'update calls']),
+        },
+        'nindexes': 2,
+        'indexDetails': {},
+        'totalIndexSize': 40000,
+        'indexSizes': {'_id_': 20000, 'created_1': 20000},
+        'ok': 1.0,
+    }
+
+
+def list_databases(names):
+    # nameOnly reply
+    return {'databases': [{'name': name} for name in names], 'ok': 1.0}
+
+
+def collection_names(count):
+    return ['collection%05d' % i for i in range(count)] + ['system.views']
+
+
+def oplog_stats():
+    return {
+        'ns': 'local.oplog.rs',
+        'size': 40 << 30,
+        'count': 90000000,
+        'avgObjSize': 477,
+        'storageSize': 12 << 30,
+        'capped': True,
+        'max': -1,
+        'maxSize': 50 << 30,
+        'nindexes': 0,
+        'totalIndexSize': 0,
+        'ok': 1.0,
+    }
+
+
+def oplog_entry(seconds_ago):
+    return {'ts': ts(seconds_ago), 't': 5, 'h': 0, 'v': 2, 'op': 'n', 'ns': '', 'wall': NOW - timedelta(seconds=seconds_ago),
+            'o': {'msg': 'periodic noop'}}
@@ -0,0 +1,57 @@
+#
+# Loads the plugins on top of the collectd.py stub without running them, and
+# drives their clock
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import collectd
+
+REGISTER_FUNCTIONS = ['register_config', 'register_init', 'register_read', 'register_shutdown']
+
+
+def ignore(*args, **kwargs):
+    pass
+
+
+def load_plugins():
+    # the stub runs every callback as soon as it is registered, against a
+    # hard-coded server; the benchmarks drive the plugin objects themselves
+    saved = dict((name, getattr(collectd, name)) for name in REGISTER_FUNCTIONS)
+    for name in REGISTER_FUNCTIONS:
+        setattr(collectd, name, ignore)
+    try:
+        import mongodb
+        import mongodb_replset
+    finally:
+        for name, func in saved.items():
+            setattr(collectd, name, func)
+    return mongodb, mongodb_replset
+
+
+class Clock(object):
+    """Stands in for the time module of the plugins so that polls run back
+    to back see the time advance by a poll interval each, as in collectd"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def install_clock(now, modules):
+    clock = Clock(now)
+    for module in modules:
+        module.time = clock
+    return clock
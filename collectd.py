@@ -1,5 +1,16 @@
+import os
 import time
 
+DS_TYPE_COUNTER = 0
+DS_TYPE_GAUGE = 1
+DS_TYPE_DERIVE = 2
+DS_TYPE_ABSOLUTE = 3
+
+DS_TYPES = {'COUNTER': DS_TYPE_COUNTER, 'GAUGE': DS_TYPE_GAUGE, 'DERIVE': DS_TYPE_DERIVE, 'ABSOLUTE': DS_TYPE_ABSOLUTE}
+
+# the data sets of the types.db next to this file, loaded on first use
+datasets = None
+
 class ConfigNode:
   def __init__(self, key, values):
     self.key = key
@@ -13,28 +24,61 @@ class Config:
     self.children.append(ConfigNode(key,[value]))
 
 class Values():
-  def __init__(self):
+  def __init__(self, **kwargs):
     self.plugin = None
     self.plugin_instance = None
     self.type = None
     self.type_instance = None
+    self.time = 0
     self.values = []
+    for key, value in kwargs.items():
+      setattr(self, key, value)
+
+  def dispatch(self, **kwargs):
+    plugin = "{}".format(kwargs.get('plugin', self.plugin))
+    plugin_instance = kwargs.get('plugin_instance', self.plugin_instance)
+    type = kwargs.get('type', self.type)
+    type_instance = kwargs.get('type_instance', self.type_instance)
 
-  def dispatch(self):
-    plugin = "{}".format(self.plugin)
+    if plugin_instance:
+      plugin = "{}-{}".format(plugin, plugin_instance)
 
-    if self.plugin_instance:
-      plugin = "{}-{}".format(self.plugin, self.plugin_instance)
+    for v in kwargs.get('values', self.values):
+      print("...{}.{}-{} {}".format(plugin, type, type_instance, v))
 
-    for v in self.values:
-      print "...{}.{}-{} {}".format(plugin, self.type, self.type_instance, v)
+def limit(value):
+  return None if value == 'U' else float(value)
+
+def get_dataset(name):
+  global datasets
+  if datasets is None:
+    datasets = {}
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'types.db')) as f:
+      for line in f:
+        fields = line.split(None, 1)
+        if len(fields) < 2 or fields[0].startswith('#'):
+          continue
+        sources = [ds.strip().split(':') for ds in fields[1].split(',')]
+        datasets[fields[0]] = [(n, DS_TYPES[t], limit(lo), limit(hi)) for n, t, lo, hi in sources]
+  if name not in datasets:
+    raise TypeError("Dataset %s not found" % name)
+  return datasets[name]
+
+def info(message):
+  print("{}".format(message))
 
 def warning(message):
-  print "{}".format(message)
+  print("{}".format(message))
+
+def error(message):
+  print("{}".format(message))
+
+def register_init(plugin_init_func):
+  plugin_init_func()
 
 def register_read(plugin_query_func):
   plugin_query_func()
-  print "..."
+  print("...")
 
 def register_config(plugin_config):
   test_config = Config()
@@ -42,3 +86,6 @@ def register_config(plugin_config):
   test_config.add('Port', '37268')
 
   plugin_config(test_config)
+
+def register_shutdown(plugin_shutdown_func):
+  plugin_shutdown_func()
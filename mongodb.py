@@ -3,22 +3,365 @@
 #
 
 import collectd
-from pymongo import MongoClient
-from pymongo.read_preferences import ReadPreference
-from distutils.version import LooseVersion as V
+from mongodb_core import BackgroundPoller, Dispatcher, InstrumentedClient, LagTracker, LatencyHistograms, LoadShedder, Metric, MetricMap, NameCache, PollStats, ReplicationStatus, Schedule, ServerStatusProjection, Snapshot, TopTracker, WorkerPool
+from mongodb_core import DEFAULT_RECORD_SIZE, RECORD_EMPTY, RECORD_POLL, SELF_PLUGIN, SHED_MODES, SHED_NORMAL
+from mongodb_core import acquire_recorder, acquire_server, host_label, is_load_error, is_timeout, log_exception, release_recorder, release_server
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+from fnmatch import fnmatch
 
-import traceback
-import re
 import time
-from time import mktime
+from timeit import default_timer as timer
 from datetime import datetime
-import math
 
 
-def tstofloat(d):
-    return time.mktime(d.timetuple())
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_WORKERS = 4
+DEFAULT_POLL_INTERVAL = 10.0
+
+DEFAULT_COLLECTIONS_PER_INTERVAL = 100
+DEFAULT_COLLECTION_LIST_INTERVAL = 300.0
+DEFAULT_COLLECTION_EXCLUDE = ['*.system.*']
+
+DEFAULT_INDEX_STATS_PER_INTERVAL = 100
+DEFAULT_UNUSED_INDEX_HOURS = 24
+
+# $indexStats of a collection, without the index specifications
+INDEX_STATS_PIPELINE = [{'$indexStats': {}}, {'$project': {'name': 1, 'accesses': 1}}]
+
+DEFAULT_CLUSTER_REFRESH_INTERVAL = 300.0
+
+# collectors a mongos has nothing for, or whose statistics the shard members
+# already report
+MONGOS_DISABLED_COLLECTORS = ['wired_tiger', 'current_op', 'oplog_status', 'db_status', 'collection_stats', 'index_stats', 'top', 'replset_status']
+
+DEFAULT_DATABASE_LIST_INTERVAL = 300.0
+DEFAULT_DATABASE_EXCLUDE = ['local', 'config']
+DEFAULT_DATABASE_WORKERS = 4
+DEFAULT_DATABASE_TIMEOUT = 2.0
+
+# serverStatus sections read by do_server_status besides its metric table
+SERVER_STATUS_SECTIONS = ['repl']
+
+# the serverStatus of the op_latencies collector, whose opLatencies section
+# only has histograms when asked for
+OP_LATENCIES_OPTIONS = {'opLatencies': {'histograms': True}}
+
+# the wiredTiger subtrees the wired_tiger collector decodes out of the
+# serverStatus of its own, which excludes every other section
+WIRED_TIGER_PATHS = [['wiredTiger', section] for section in ['block-manager', 'cache', 'concurrentTransactions', 'transaction']]
+
+# collectors in the order a poll runs them; op_latencies, wired_tiger,
+# current_op, index_stats, top and replset_status only run when given an
+# interval
+COLLECTORS = ['server_status', 'op_latencies', 'wired_tiger', 'current_op', 'oplog_status', 'db_status', 'collection_stats', 'index_stats', 'top', 'replset_status']
+DEFAULT_INTERVALS = {'op_latencies': -1, 'wired_tiger': -1, 'current_op': -1, 'index_stats': -1, 'top': -1, 'replset_status': -1}
+
+# collectors slowed down, then stopped, by the load shedding when the server
+# struggles; server_status (connections, opcounters...) always runs
+EXPENSIVE_COLLECTORS = ['current_op', 'oplog_status', 'db_status', 'collection_stats', 'index_stats', 'top', 'replset_status']
+
+DEFAULT_TOP_NAMESPACES = 10
+
+# the $currentOp aggregation of the current_op collector tags itself with
+# this comment to leave itself out; op types always reported, and lower
+# bounds in seconds of the secs_running buckets
+CURRENT_OP_COMMENT = 'collectd-mongodb current_op'
+CURRENT_OP_MAX_TIME_MS = 1000
+CURRENT_OP_TYPES = ['query', 'getmore', 'insert', 'update', 'remove', 'command', 'killcursors', 'none']
+CURRENT_OP_RUNNING = [0, 1, 10, 60, 600]
+DEFAULT_CURRENT_OP_DATABASES = 10
+
+LOCK_MODES = {'r': 'intent-shared-read', 'w': 'intent-excl-write', 'R': 'shared-read', 'W': 'excl-write'}
+OPCOUNTERS = ['getmore', 'query', 'insert', 'update', 'delete']
+
+# serverStatus metrics; those marked default=False are only collected when
+# selected with IncludeMetric
+SERVER_STATUS_METRICS = [
+    Metric('connections.current', 'cnx_count', 'current'),
+    Metric('connections.totalCreated', 'cnx_created_delta', 'created_per_second'),
+] + [
+    Metric('network.%s' % t, 'network', '%s_per_sec' % t) for t in ['bytesIn', 'bytesOut'] #, 'physicalBytesIn', 'physicalBytesOut']
+] + [
+    Metric('opcounters.%s' % t, 'opcounters', '%s_per_sec' % t) for t in OPCOUNTERS
+] + [
+    Metric('opcountersRepl.%s' % t, 'opcounters_repl', '%s_per_sec' % t) for t in OPCOUNTERS
+] + [
+    # 'mapped' is useless because we don't use MMAPv1 storage engine
+    Metric('mem.resident', 'memory', 'resident'),
+    Metric('mem.virtual', 'memory', 'virtual'),
+    Metric('extra_info.page_faults', 'page_faults', 'page_faults'),
+
+    Metric('uptime', 'uptime', 'value', default=False),
+    Metric('opcounters.*', 'total_operations', '{0}', default=False),
+    Metric('opcounters.*', 'opcounters', '{0}', default=False),
+    Metric('opcountersRepl.*', 'opcounters_repl', '{0}', default=False),
+    Metric('asserts.*', 'asserts', '{0}', default=False),
+    Metric('connections.*', 'connections', '{0}', default=False),
+] + [
+    Metric('metrics.%s.*' % k, 'metrics_%s' % k.lower(), '{0}', default=False, lower=True)
+    for k in ['document', 'operation', 'queryExecutor', 'record']
+] + [
+    Metric('metrics.getLastError.wtimeouts', 'metrics_get_last_error', 'wtimeouts', default=False),
+    Metric('metrics.getLastError.wtime.*', 'metrics_get_last_error', 'wtime-{0}', default=False),
+    Metric('metrics.cursor.timedOut', 'metrics_cursor', 'timed_out', default=False),
+    Metric('metrics.cursor.open.*', 'metrics_cursor', 'open-{0}', default=False),
+    Metric('metrics.repl.executor.*', 'metrics_repl_executor', '{0}', default=False),
+    Metric('metrics.repl.executor.counters.*', 'metrics_repl_executor', 'counters-{0}', default=False),
+    Metric('metrics.repl.executor.queues.*', 'metrics_repl_executor', 'queues-{0}', default=False),
+    Metric('metrics.repl.apply.*', 'metrics_repl_apply', '{0}', default=False),
+    Metric('metrics.repl.apply.batches.*', 'metrics_repl_apply', 'batches-{0}', default=False),
+    Metric('metrics.repl.network.*', 'metrics_repl_network', '{0}', default=False),
+    Metric('metrics.repl.network.getmores.*', 'metrics_repl_network', 'getmores-{0}', default=False),
+    Metric('metrics.repl.preload.*.*', 'metrics_repl_preload', '{0}-{1}', default=False),
+    Metric('metrics.repl.buffer.*', 'metrics_repl_buffer', '{0}', default=False),
+    Metric('metrics.storage.*.*.*', 'metrics_storage_{0}', '{1}-{2}', default=False),
+    Metric('metrics.ttl.*', 'metrics_ttl', '{0}', default=False),
+    Metric('network.bytesIn', 'bytes', 'bytesIn', default=False),
+    Metric('network.bytesOut', 'bytes', 'bytesOut', default=False),
+    Metric('network.numRequests', 'bytes', 'numRequests', default=False),
+    Metric('globalLock.totalTime', 'global_lock', 'total_time', default=False),
+    Metric('globalLock.currentQueue.*', 'global_lock', 'currentqueue-{0}', default=False),
+    Metric('globalLock.activeClients.*', 'global_lock', 'activeclients-{0}', default=False),
+    Metric('locks.*.*.*', 'locks_{0}', '{1}-{2}', default=False, lower=True, labels=LOCK_MODES),
+]
+
+# serverStatus.wiredTiger metrics of the wired_tiger collector; sizes, tickets
+# and the running checkpoint are gauges, the rest counters since startup
+WIRED_TIGER_METRICS = [
+    Metric('wiredTiger.cache.%s' % k, 'wiredtiger_cache', name) for k, name in [
+        ('bytes currently in the cache', 'bytes'),
+        ('tracked dirty bytes in the cache', 'dirty_bytes'),
+        ('maximum bytes configured', 'max_bytes'),
+    ]
+] + [
+    Metric('wiredTiger.cache.%s' % k, 'wiredtiger_cache_ops', name) for k, name in [
+        ('bytes read into cache', 'bytes_read'),
+        ('bytes written from cache', 'bytes_written'),
+        ('pages read into cache', 'pages_read'),
+        ('pages written from cache', 'pages_written'),
+        ('unmodified pages evicted', 'evicted_unmodified'),
+        ('modified pages evicted', 'evicted_modified'),
+        ('pages evicted by application threads', 'evicted_by_application'),
+    ]
+] + [
+    Metric('wiredTiger.concurrentTransactions.*.*', 'wiredtiger_tickets', '{0}-{1}', labels={'out': 'in_use', 'totalTickets': 'total'}),
+] + [
+    Metric('wiredTiger.block-manager.%s' % k, 'wiredtiger_block', k.replace(' ', '_'))
+    for k in ['blocks read', 'blocks written', 'bytes read', 'bytes written']
+] + [
+    Metric('wiredTiger.transaction.transaction checkpoints', 'wiredtiger_checkpoints', 'count'),
+    Metric('wiredTiger.transaction.transaction checkpoint total time (msecs)', 'wiredtiger_checkpoints', 'time_ms'),
+    Metric('wiredTiger.transaction.transaction checkpoint currently running', 'wiredtiger_checkpoint', 'running'),
+    Metric('wiredTiger.transaction.transaction checkpoint most recent time (msecs)', 'wiredtiger_checkpoint', 'last_time_ms'),
+]
+
+
+def current_op_pipeline(databases):
+    """$currentOp aggregation summing up the active operations on the
+    server side into a single document"""
+    return [
+        {'$currentOp': {'allUsers': True}},
+        {'$match': {'active': True, 'command.comment': {'$ne': CURRENT_OP_COMMENT}}},
+        {'$facet': {
+            'total': [{'$group': {
+                '_id': None,
+                'active': {'$sum': 1},
+                'waiting_for_lock': {'$sum': {'$cond': ['$waitingForLock', 1, 0]}},
+                'waiting_for_flow_control': {'$sum': {'$cond': ['$waitingForFlowControl', 1, 0]}},
+            }}],
+            'op': [{'$group': {'_id': '$op', 'count': {'$sum': 1}}}],
+            'database': [
+                {'$group': {'_id': {'$arrayElemAt': [{'$split': [{'$ifNull': ['$ns', '']}, '.']}, 0]}, 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1}},
+                {'$limit': databases},
+            ],
+            'running': [{'$bucket': {
+                'groupBy': {'$ifNull': ['$secs_running', 0]},
+                'boundaries': CURRENT_OP_RUNNING,
+                'default': CURRENT_OP_RUNNING[-1],
+                'output': {'count': {'$sum': 1}},
+            }}],
+        }},
+    ]
+
+
+class DatabaseList(object):
+    """The databases whose dbstats and collections are collected.
+
+    Those given with the Database key, followed, when discovery is on, by
+    the databases returned by listDatabases that match the include and
+    exclude patterns. The listing is refreshed every `list_interval` seconds
+    so that databases created or dropped since are picked up or forgotten.
+    """
 
-class MongoDB(object):
+    def __init__(self):
+        self.discover = False
+        self.list_interval = DEFAULT_DATABASE_LIST_INTERVAL
+        self.include = []
+        self.exclude = list(DEFAULT_DATABASE_EXCLUDE)
+
+        self.discovered = None
+        self.listed = 0
+
+    def wanted(self, name):
+        if self.include and not [p for p in self.include if fnmatch(name, p)]:
+            return False
+        return not [p for p in self.exclude if fnmatch(name, p)]
+
+    def refresh(self, con, now):
+        if not self.discover or (self.discovered is not None and now - self.listed < self.list_interval):
+            return
+        reply = con['admin'].command('listDatabases', nameOnly=True)
+        self.discovered = sorted(d['name'] for d in reply['databases'] if self.wanted(d['name']))
+        self.listed = now
+
+    def names(self, con, configured, now):
+        self.refresh(con, now)
+        if not self.discovered:
+            return configured
+        return list(configured) + [name for name in self.discovered if name not in configured]
+
+
+class CollectionScanner(object):
+    """Bounded, rotating collStats collection over the monitored databases.
+
+    Collection names are listed every list_interval seconds and filtered
+    through the include/exclude patterns, which are matched against
+    "<database>.<collection>". Each interval at most `budget` collections get
+    a fresh collStats, continuing where the previous interval stopped, and
+    only those are reported: the statistics are counters, and reporting the
+    values of an earlier visit again would read as no growth until the
+    next visit.
+    """
+
+    def __init__(self):
+        self.budget = DEFAULT_COLLECTIONS_PER_INTERVAL
+        self.list_interval = DEFAULT_COLLECTION_LIST_INTERVAL
+        self.include = []
+        self.exclude = list(DEFAULT_COLLECTION_EXCLUDE)
+
+        self.namespaces = None
+        self.listed = 0
+        self.position = 0
+
+    def wanted(self, mongo_db, collection):
+        ns = '%s.%s' % (mongo_db, collection)
+        if self.include and not [p for p in self.include if fnmatch(ns, p)]:
+            return False
+        return not [p for p in self.exclude if fnmatch(ns, p)]
+
+    def refresh(self, con, databases, now):
+        if self.namespaces is not None and now - self.listed < self.list_interval:
+            return
+        namespaces = []
+        for mongo_db in databases:
+            for collection in sorted(con[mongo_db].collection_names()):
+                if self.wanted(mongo_db, collection):
+                    namespaces.append((mongo_db, collection))
+        self.namespaces = namespaces
+        self.listed = now
+        if self.position >= len(namespaces):
+            self.position = 0
+
+    def scan(self, con, databases, now):
+        """Returns [(namespace, [(statistic, value), ...]), ...] for the
+        collections visited during this interval"""
+        self.refresh(con, databases, now)
+        namespaces = self.namespaces
+        count = min(self.budget, len(namespaces))
+        visited = []
+        for i in range(count):
+            ns = namespaces[(self.position + i) % len(namespaces)]
+            try:
+                stats = con[ns[0]].command('collstats', ns[1])
+            except OperationFailure:
+                # dropped since the last listing
+                continue
+            cursor = stats.get('wiredTiger', {}).get('cursor', {})
+            visited.append((ns, sorted(cursor.items())))
+        if namespaces:
+            self.position = (self.position + count) % len(namespaces)
+        return visited
+
+
+class IndexScanner(object):
+    """Bounded, rotating $indexStats collection over the monitored collections.
+
+    The collections are those listed by the collection scanner, through its
+    include/exclude patterns. Each interval at most `budget` of them are
+    visited, continuing where the previous interval stopped. A visit turns
+    the accesses.ops counter of each index into operations per second since
+    the previous visit, reported for that interval only, and notes when the
+    index was last seen used: when its counter moved, or when the counter
+    started if it never did. Counters restart with the server and the index.
+    The cache keeps the last visit of every collection for the next rates
+    and the unused counts.
+    """
+
+    def __init__(self, collections):
+        self.collections = collections
+        self.budget = DEFAULT_INDEX_STATS_PER_INTERVAL
+        self.unused_hours = DEFAULT_UNUSED_INDEX_HOURS
+
+        self.position = 0
+        # (database, collection) -> index name -> (since, ops, visited, rate, used)
+        self.cache = {}
+
+    def scan(self, con, databases, now):
+        """Returns the namespaces visited during this interval"""
+        self.collections.refresh(con, databases, now)
+        namespaces = self.collections.namespaces
+        listed = set(namespaces)
+        for ns in list(self.cache):
+            if ns not in listed:
+                del self.cache[ns]
+        if self.position >= len(namespaces):
+            self.position = 0
+        count = min(self.budget, len(namespaces))
+        visited = []
+        for i in range(count):
+            ns = namespaces[(self.position + i) % len(namespaces)]
+            try:
+                reply = con[ns[0]].command('aggregate', ns[1], pipeline=INDEX_STATS_PIPELINE, cursor={})
+            except OperationFailure:
+                # dropped since the last listing
+                self.cache.pop(ns, None)
+                continue
+            self.cache[ns] = self.update(self.cache.get(ns, {}), reply['cursor']['firstBatch'], now)
+            visited.append(ns)
+        if namespaces:
+            self.position = (self.position + count) % len(namespaces)
+        return visited
+
+    def update(self, previous, stats, now):
+        indexes = {}
+        for doc in stats:
+            accesses = doc.get('accesses', {})
+            ops = accesses.get('ops', 0)
+            since = accesses.get('since')
+            since = (since - datetime(1970, 1, 1)).total_seconds() if since is not None else now
+            # an index first seen used was last used some time before now
+            rate = None
+            used = now if ops else since
+            last = previous.get(doc['name'])
+            if last is not None:
+                last_since, last_ops, visited, last_rate, last_used = last
+                if since != last_since:
+                    used = now if ops else last_used
+                else:
+                    if now > visited:
+                        rate = (ops - last_ops) / (now - visited)
+                    used = now if ops != last_ops else last_used
+            indexes[doc['name']] = (since, ops, now, rate, used)
+        return indexes
+
+    def unused(self, indexes, now):
+        """The number of indexes not used for unused_hours"""
+        horizon = now - self.unused_hours * 3600
+        return len([1 for since, ops, visited, rate, used in indexes.values() if used <= horizon])
+
+
+class MongoDB(ReplicationStatus):
 
     def __init__(self):
         self.plugin_name = "mongodb"
@@ -27,412 +370,669 @@ class MongoDB(object):
         self.mongo_db = ["admin", ]
         self.mongo_user = None
         self.mongo_password = None
-
-        self.lockTotalTime = None
-        self.lockTime = None
-        self.accesses = None
-        self.misses = None
+        self.plugin_instance = None
+        self.timeout = DEFAULT_TIMEOUT
+        self.server = None
+        self.connection = None
+        self.databases = DatabaseList()
+        self.database_workers = DEFAULT_DATABASE_WORKERS
+        self.database_timeout = DEFAULT_DATABASE_TIMEOUT
+        self.database_pool = None
+        self.database_jobs = {}
+        # databases whose dbstats completed after the end of a poll, reported
+        # by the next one
+        self.database_late = set()
+        # end of the current poll's timeout, on the timer() clock
+        self.poll_deadline = 0
+        # load errors and timeouts of the dbstats jobs of the current poll,
+        # for the load shedder
+        self.database_errors = self.database_timeouts = 0
+        self.collections = CollectionScanner()
+        self.indexes = IndexScanner(self.collections)
+        self.top = TopTracker(DEFAULT_TOP_NAMESPACES)
+        self.current_op_databases = DEFAULT_CURRENT_OP_DATABASES
+        self.last_write = None
+        self.lags = LagTracker()
+        self.max_age = 0
+        self.schedule = Schedule(DEFAULT_INTERVALS)
+        self.server_status = ServerStatusProjection(SERVER_STATUS_SECTIONS)
+        self.op_latencies_status = ServerStatusProjection(['opLatencies'], OP_LATENCIES_OPTIONS)
+        self.op_latencies = LatencyHistograms()
+        self.wired_tiger_status = ServerStatusProjection(['wiredTiger'])
+        self.wired_tiger_metrics = None
+        self.include_metrics = []
+        self.exclude_metrics = []
+        self.server_status_metrics = None
+        self.values = []
+        self.snapshot = None
+        self.dispatched = None
+        self.dispatcher = Dispatcher()
+        self.name = NameCache()
+        self.stats = PollStats()
+        self.shedder = LoadShedder()
+        self.record_file = None
+        self.record_size = DEFAULT_RECORD_SIZE
 
     def submit(self, type, instance, value, db=None):
+        plugin_instance = self.plugin_instance or str(self.mongo_port)
         if db:
-            plugin_instance = '%s-%s' % (self.mongo_port, db)
-        else:
-            plugin_instance = str(self.mongo_port)
-        v = collectd.Values()
-        v.plugin = self.plugin_name
-        v.plugin_instance = plugin_instance
-        v.type = type
-        v.type_instance = instance
-        v.values = [value, ]
-        v.dispatch()
+            plugin_instance = '%s-%s' % (plugin_instance, db)
+        self.submit_raw(self.plugin_name, plugin_instance, type, instance, value)
 
     def submit_repl_info(self, replset, type, instance, value):
         self.submit_raw(self.plugin_name, replset, type, instance, value)
 
     def submit_raw(self, plugin_name, plugin_instance, type, instance, value):
-        v = collectd.Values()
-        v.plugin = plugin_name
-        v.plugin_instance = plugin_instance
-        v.type = type
-        v.type_instance = instance
-        v.values = [value, ]
-        v.dispatch()
+        self.values.append((plugin_name, plugin_instance, type, instance, value))
 
     def get_db_and_collection_stats(self):
-        con = MongoClient(host=self.mongo_host, port=self.mongo_port, read_preference=ReadPreference.SECONDARY)
-    	try:
-            db = con['admin']
-            if self.mongo_user and self.mongo_password:
-                db.authenticate(self.mongo_user, self.mongo_password)
-            self.do_server_status(db)
-            
-            
-#            self.do_server_status(db)
-#            self.do_replset_get_status(db)
-
-            db = con['local']
-            #if self.mongo_user and self.mongo_password:
-            #    db.authenticate(self.mongo_user, self.mongo_password)
-
-            self.do_oplog_status(db)
-            
-#            for mongo_db in self.mongo_db:
-#                db = con[mongo_db]
-#                if self.mongo_user and self.mongo_password:
-#                    db.authenticate(self.mongo_user, self.mongo_password)
-#                self.do_db_status(db, mongo_db)
-        except:
-            traceback.print_exc()
-        finally:
-            con.close()
+        if self.server is None:
+            # cluster members are created by the discovery and set up by
+            # their first poll
+            self.init()
+        stats = self.stats
+        stats.start()
+        start = timer()
+        self.poll_deadline = start + self.timeout
+        con = self.connection.get()
+        stats.add('connect', None, timer() - start)
+        self.values = []
+        now = time.time()
+        stats.record('%s %s' % (RECORD_POLL, self.plugin_name), RECORD_EMPTY)
+        if con is None:
+            stats.error('connect')
+        else:
+            self.collect(InstrumentedClient(con, stats), now)
+        stats.add('poll', None, timer() - start)
+        plugin_instance = self.plugin_instance or str(self.mongo_port)
+        stats.report(self.submit_raw, plugin_instance)
+        self.submit_raw(SELF_PLUGIN, plugin_instance, 'self_mode', 'load_shedding', self.shedder.mode)
+        self.snapshot = Snapshot(now, self.values)
+
+    def collect(self, con, now):
+        horizon = self.schedule.start(now)
+        self.max_age = horizon - now
+        slowdown = self.shedder.slowdown(now)
+        probing = self.shedder.probing
+        errors = timeouts = expensive = 0
+        self.database_errors = self.database_timeouts = 0
+        for collector in COLLECTORS:
+            if collector in EXPENSIVE_COLLECTORS:
+                if slowdown is None or not self.schedule.due(collector, now, horizon, slowdown, probing):
+                    continue
+                expensive += 1
+            elif not self.schedule.due(collector, now, horizon):
+                continue
+            try:
+                self.stats.collector(collector, self.values, getattr(self, 'collect_' + collector), con, now)
+            except Exception as e:
+                self.connection.failed()
+                log_exception(self.plugin_name, "%s collector failed on %s" % (collector, self.describe()))
+                errors += is_load_error(e)
+                timeouts += is_timeout(e)
+                if isinstance(e, ConnectionFailure):
+                    break
+        # the dbstats jobs count as one collector however many databases failed
+        errors += min(1, self.database_errors)
+        timeouts += min(1, self.database_timeouts)
+        if self.shedder.update(now, self.stats.mean_round_trip(), errors, timeouts, expensive):
+            log = collectd.info if self.shedder.mode == SHED_NORMAL else collectd.warning
+            log("mongodb plugin: load shedding on %s is now %s (mean round trip %.3fs)" % (
+                self.describe(), SHED_MODES[self.shedder.mode], self.shedder.latency or 0))
+
+    def collect_server_status(self, con, now):
+        self.do_server_status(con['admin'])
+
+    def collect_op_latencies(self, con, now):
+        self.do_op_latencies(con['admin'])
+
+    def collect_wired_tiger(self, con, now):
+        self.do_wired_tiger(con['admin'])
+
+    def collect_current_op(self, con, now):
+        self.do_current_op(con['admin'])
+
+    def collect_oplog_status(self, con, now):
+        self.do_oplog_status(con['local'])
+
+    def collect_db_status(self, con, now):
+        # dbstats runs concurrently on the database pool. Each is given
+        # database_timeout from when a worker starts it, and all of them what
+        # is left of the poll's timeout: a database whose dbstats runs longer
+        # is skipped for this poll, and for the next ones as long as its
+        # dbstats is still running, while one still queued or within its
+        # timeout when the poll runs out of time is reported by the next poll
+        jobs = []
+        names = self.databases.names(con, self.mongo_db, now)
+        for mongo_db in names:
+            job = self.database_jobs.get(mongo_db)
+            if job is not None and not job.done.is_set():
+                continue
+            if mongo_db in self.database_late:
+                self.database_late.discard(mongo_db)
+            else:
+                job = self.database_jobs[mongo_db] = self.database_pool.submit(self.get_db_stats, con[mongo_db], mongo_db)
+            jobs.append((mongo_db, job))
+        for mongo_db in list(self.database_jobs):
+            if mongo_db not in names:
+                del self.database_jobs[mongo_db]
+                self.database_late.discard(mongo_db)
+
+        for mongo_db, job in jobs:
+            if not self.wait_db_stats(job):
+                if job.started is None or timer() < job.started + self.database_timeout:
+                    self.database_late.add(mongo_db)
+                    continue
+                self.stats.error('db_status')
+                self.database_errors += 1
+                self.database_timeouts += 1
+                collectd.warning("mongodb plugin: dbstats of %s on %s did not complete within %.1fs, skipping" % (
+                    mongo_db, self.describe(), self.database_timeout))
+                continue
+            if job.result is None:
+                # failed outside the command, already logged by the job
+                continue
+            db_stats, error = job.result
+            if error is not None:
+                self.database_errors += is_load_error(error)
+                self.database_timeouts += is_timeout(error)
+            else:
+                self.do_db_status(db_stats, mongo_db)
+
+    def wait_db_stats(self, job):
+        """Waits for a dbstats job until its own timeout, counted from when
+        it starts, or the end of the poll; returns whether it completed"""
+        while not job.done.is_set():
+            now = timer()
+            # a job not started yet cannot time out before now + timeout
+            started = job.started if job.started is not None else now
+            deadline = min(self.poll_deadline, started + self.database_timeout)
+            if now >= deadline:
+                return False
+            job.wait(deadline - now)
+        return True
+
+    def get_db_stats(self, db, mongo_db):
+        """Returns the dbstats reply and None, or None and the error"""
+        try:
+            return db.command('dbstats', maxTimeMS=int(self.database_timeout * 1000)), None
+        except PyMongoError as e:
+            self.stats.error('db_status')
+            log_exception(self.plugin_name, "dbstats of %s failed on %s" % (mongo_db, self.describe()))
+            return None, e
+
+    def collect_collection_stats(self, con, now):
+        self.do_collection_stats(con, now)
+
+    def collect_index_stats(self, con, now):
+        self.do_index_stats(con, now)
+
+    def collect_top(self, con, now):
+        self.do_top(con['admin'], now)
+
+    def collect_replset_status(self, con, now):
+        self.do_replset_get_status(con['admin'])
+
+    def flush(self):
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot is not self.dispatched:
+            start = timer()
+            dispatched = self.dispatcher.flush(snapshot)
+            self.stats.dispatch_time = timer() - start
+            if self.dispatcher.changes.enabled:
+                self.stats.dispatched = dispatched
+            self.dispatched = snapshot
 
     def do_server_status(self, db):
         
-        server_status = db.command('serverStatus')
+        server_status = db.command(self.server_status.command())
+        self.server_status.learn(server_status)
         now = (server_status['localTime'] - datetime(1970,1,1)).total_seconds()
 
-        cnx_stat = server_status['connections']
-        self.submit('cnx_count', 'current', cnx_stat['current'])
-        #self.submit('cnx_count', 'available', cnx_stat['available'])
-        self.submit('cnx_created_delta', 'created_per_second', cnx_stat['totalCreated'])
+        self.server_status_metrics.extract(server_status, self.submit)
         
-        net_stat = server_status['network']
-        for t in ['bytesIn', 'bytesOut']: #, 'physicalBytesIn', 'physicalBytesOut']:
-            self.submit('network', "{0}_per_sec".format(t), net_stat[t])
-
-        # operations
-        ops = server_status['opcounters']
-        for t in ['getmore', 'query', 'insert', 'update', 'delete']:
-            self.submit('opcounters', "{0}_per_sec".format(t), ops[t])
-            
-        # operations replication
-        ops = server_status['opcountersRepl']
-        for t in ['getmore', 'query', 'insert', 'update', 'delete']:
-            self.submit('opcounters_repl', "{0}_per_sec".format(t), ops[t])
-
-        # memory
-        for t in ['resident', 'virtual']: # 'mapped' is useless because we don't use MMAPv1 storage engine
-            self.submit('memory', t, server_status['mem'][t])
-            
-        # page faults
-        self.submit('page_faults', 'page_faults', server_status['extra_info']['page_faults'])
-        collectd.info("fault=%d" % server_status['extra_info']['page_faults'])
-        
-        # Replication lag
-        lag = now - server_status['repl']['lastWrite']['opTime']['ts'].time
+        # Replication lag; mongos and standalone servers have no repl section
+        repl = server_status.get('repl')
+        if repl is None or 'lastWrite' not in repl:
+            self.last_write = None
+            return
+        self.last_write = repl['lastWrite']['opTime']['ts']
+        lag = now - self.last_write.time
         self.submit('replication', 'replication_lag', lag)
 
 
+    def do_op_latencies(self, db):
+        server_status = db.command(self.op_latencies_status.command())
+        self.op_latencies_status.learn(server_status)
+        for category, latencies in self.op_latencies.update(server_status.get('opLatencies', {})):
+            for name, value in latencies:
+                self.submit('op_latency', self.name('{0}-{1}', category, name), value)
+
+    def do_wired_tiger(self, db):
+        # the reply is left undecoded but for the few wiredTiger sections read
+        reply = db.raw_command(self.wired_tiger_status.command())
+        self.wired_tiger_status.learn_raw(reply)
+        server_status = self.stats.decode('serverStatus', reply, WIRED_TIGER_PATHS)
+        self.wired_tiger_metrics.extract(server_status, self.submit)
+
+        # cache fill and dirty ratios, and tickets in use; servers running
+        # another storage engine have no wiredTiger section
+        wt = server_status.get('wiredTiger', {})
+        cache = wt.get('cache', {})
+        size = cache.get('maximum bytes configured')
+        if size:
+            self.submit('percent', 'wiredtiger_cache_fill', 100.0 * cache.get('bytes currently in the cache', 0) / size)
+            self.submit('percent', 'wiredtiger_cache_dirty', 100.0 * cache.get('tracked dirty bytes in the cache', 0) / size)
+        for op, tickets in sorted(wt.get('concurrentTransactions', {}).items()):
+            if isinstance(tickets, dict) and tickets.get('totalTickets'):
+                self.submit('percent', self.name('wiredtiger_tickets_{0}_in_use', op), 100.0 * tickets.get('out', 0) / tickets['totalTickets'])
+
+    def do_current_op(self, db):
+        reply = db.command('aggregate', 1, pipeline=current_op_pipeline(self.current_op_databases), cursor={},
+                           maxTimeMS=CURRENT_OP_MAX_TIME_MS, comment=CURRENT_OP_COMMENT)
+        summary = reply['cursor']['firstBatch'][0]
+        total = summary['total'][0] if summary['total'] else {}
+        for k in ['active', 'waiting_for_lock', 'waiting_for_flow_control']:
+            self.submit('current_ops', k, total.get(k, 0))
+
+        ops = dict((doc['_id'], doc['count']) for doc in summary['op'])
+        for op in CURRENT_OP_TYPES + sorted(set(ops) - set(CURRENT_OP_TYPES)):
+            self.submit('current_ops', self.name('op-{0}', op), ops.get(op, 0))
+
+        running = dict((doc['_id'], doc['count']) for doc in summary['running'])
+        for seconds in CURRENT_OP_RUNNING:
+            self.submit('current_ops', self.name('running-{0}s', seconds), running.get(seconds, 0))
+
+        # operations without a namespace have an empty database
+        for doc in summary['database']:
+            if doc['_id']:
+                self.submit('current_ops', self.name('database-{0}', doc['_id']), doc['count'])
+
     def do_oplog_status(self, db):
         # oplog
-        oplog_rs = db['oplog.rs']
-        oplog_head = oplog_rs.find(sort=[('$natural',1)], limit=1)[0]['ts']
-        oplog_tail = oplog_rs.find(sort=[('$natural',-1)], limit=1)[0]['ts']
-        time_diff = int(oplog_tail.time - oplog_head.time)
+        self.server.update_oplog(db, self.last_write)
+        oplog = self.server.oplog
+        time_diff = int(oplog.window())
         self.submit('oplog', 'width_in_second', time_diff / 1000)
+
+        rate = oplog.growth_rate()
+        if rate is not None:
+            self.submit('oplog', 'growth_bytes_per_hour', rate * 3600)
+
+        projected = oplog.projected_window()
+        if projected is not None:
+            self.submit('oplog', 'projected_window_seconds', projected)
         
         
         
-    def do_server_status_obsolete(self, db):
-        server_status = db.command('serverStatus')
-
-        version = server_status['version']
-        at_least_2_4 = V(version) >= V('2.4.0')
-
-        self.submit('uptime','value', server_status['uptime'])
-
-        # operations
-        for k, v in server_status['opcounters'].items():
-            self.submit('total_operations', k, v)
-            self.submit('opcounters', k, v)
-            
-	    # repl operations
-        for k, v in server_status['opcountersRepl'].items():
-            self.submit('opcounters_repl', k, v)
-
-
-        # asserts
-        for k, v in server_status['asserts'].items():
-            self.submit('asserts', k, v)
-
-
-
-        # connections
-        self.submit('connections', 'current', server_status['connections']['current'])
-        if 'available' in server_status['connections']:
-            self.submit('connections', 'available', server_status['connections']['available'])
-        if 'totalCreated' in server_status['connections']:
-            self.submit('connections', 'totalCreated', server_status['connections']['totalCreated'])
-
-        # metrics
-        metrics = server_status['metrics']
-        for k in ['document', 'operation', 'queryExecutor', 'record']:
-                for i, val in metrics[k].items():
-                    self.submit('metrics_{0}'.format(k.lower()), "{0}".format(i.lower()), val)
-
-        # metrics/getlasterror
-        self.submit('metrics_get_last_error','wtimeouts', server_status['metrics']['getLastError']['wtimeouts'])
-        for k,v in server_status['metrics']['getLastError']['wtime'].items():
-            self.submit('metrics_get_last_error', "wtime-{0}".format(k), v)
-
-        # metrics/cursor
-        self.submit('metrics_cursor','timed_out', server_status['metrics']['cursor']['timedOut'])
-        for k,v in server_status['metrics']['cursor']['open'].items():
-            self.submit('metrics_cursor', "open-{0}".format(k), v)
-
-        # metrics/repl/executor metrics
-        if 'executor' in metrics['repl']:
-            for k, v in metrics['repl']['executor'].items():
-                if k in ['networkInterface', 'shuttingDown']:
-                    continue
-                elif k in ['counters', 'queues']:
-                    for a, b in v.items():
-                        self.submit('metrics_repl_executor', "{0}-{1}".format(k, a), b)
-                else:
-                    self.submit('metrics_repl_executor', "{0}".format(k), v)
-
-        # metrics/repl/apply metrics
-        for k, v in metrics['repl']['apply'].items():
-            if k in ['batches']:
-                for a, b in v.items():
-                    self.submit('metrics_repl_apply', "{0}-{1}".format(k, a), b)
-            else:
-                self.submit('metrics_repl_apply', "{0}".format(k), v)
-
-        # metrics/repl/network metrics
-        for k, v in metrics['repl']['network'].items():
-            if k in ['getmores']:
-                for a, b in v.items():
-                    self.submit('metrics_repl_network', "{0}-{1}".format(k, a), b)
-            else:
-                self.submit('metrics_repl_network', "{0}".format(k), v)
-
-        # metrics/repl/preload
-        for k, v in metrics['repl']['preload'].items():
-            if k in ['docs', 'indexes']:
-                for a, b in v.items():
-                    self.submit('metrics_repl_preload', "{0}-{1}".format(k, a), b)
-
-        for k, v in metrics['repl']['buffer'].items():
-            self.submit('metrics_repl_buffer', "{0}".format(k), v)
-
-
-        # metrics/storage
-        for k, v in metrics['storage'].items():
-            for l, w in v.items():
-                for m, x in w.items():
-                    self.submit('metrics_storage_{0}'.format(k), "{0}-{1}".format(l,m), x)
-
-        # metrics/ttl
-        for k, v in metrics['ttl'].items():
-            self.submit('metrics_ttl', "{0}".format(k), v)
-
-        # network
-        if 'network' in server_status:
-            for t in ['bytesIn', 'bytesOut', 'numRequests']:
-                self.submit('bytes', t, server_status['network'][t])
-
-        # locks (pre 3.2)
-        if 'lockTime' in server_status['globalLock']:
-            if self.lockTotalTime is not None and self.lockTime is not None:
-                if self.lockTime == server_status['globalLock']['lockTime']:
-                    value = 0.0
-                else:
-                    value = float(server_status['globalLock']['lockTime'] - self.lockTime) * 100.0 / float(server_status['globalLock']['totalTime'] - self.lockTotalTime)
-                self.submit('percent', 'lock_ratio', value)
-
-            self.lockTime = server_status['globalLock']['lockTime']
-            self.lockTotalTime = server_status['globalLock']['totalTime']
-        else:
-            self.submit('global_lock', 'total_time', server_status['globalLock']['totalTime'])
-            for k in ['currentQueue','activeClients']:
-                for m, v in server_status['globalLock'][k].items():
-                    self.submit('global_lock', '{0}-{1}'.format(k.lower(), m), v)
-
-        if 'locks' in server_status:
-            for t, stats in server_status['locks'].items():
-                typ = 'locks_{0}'.format(t.lower())
-                if t == '.':
-                  typ  = 'locks'
-                for k, grouping in stats.items():
-                    for s, v in grouping.items():
-                        if s == 'r':
-                            slabel = 'intent-shared-read'
-                        elif s == 'w':
-                            slabel = 'intent-excl-write'
-                        elif s == 'R':
-                            slabel = 'shared-read'
-                        elif s == 'W':
-                            slabel = 'excl-write'
-
-                        self.submit(typ, '{0}-{1}'.format(k.lower(), slabel), v)
-
-
-        # indexes
-        if 'indexCounters' in server_status:
-            accesses = None
-            misses = None
-            index_counters = server_status['indexCounters'] if at_least_2_4 else server_status['indexCounters']['btree']
-
-            if self.accesses is not None:
-                accesses = index_counters['accesses'] - self.accesses
-                if accesses < 0:
-                    accesses = None
-            misses = (index_counters['misses'] or 0) - (self.misses or 0)
-            if misses < 0:
-                misses = None
-            if accesses and misses is not None:
-                self.submit('cache_ratio', 'cache_misses', int(misses * 100 / float(accesses)))
-            else:
-                self.submit('cache_ratio', 'cache_misses', 0)
-            self.accesses = index_counters['accesses']
-            self.misses = index_counters['misses']
-
-    def do_db_status(self, db, mongo_db):
-        db_stats = db.command('dbstats')
-
+    def do_db_status(self, db_stats, mongo_db):
         # stats counts
         self.submit('counter', 'object_count', db_stats['objects'], mongo_db)
         self.submit('counter', 'collections', db_stats['collections'], mongo_db)
-        self.submit('counter', 'num_extents', db_stats['numExtents'], mongo_db)
+        if 'numExtents' in db_stats:
+            self.submit('counter', 'num_extents', db_stats['numExtents'], mongo_db)
         self.submit('counter', 'indexes', db_stats['indexes'], mongo_db)
 
-        # collection stats
-        collections = db.collection_names()
-        for collection in collections:
-            collection_stats = db.command('collstats', collection)
-            if 'wiredTiger' in collection_stats:
-                if 'cursor' in collection_stats['wiredTiger']:
-                    for k, v in collection_stats['wiredTiger']['cursor'].items():
-                        self.submit('collection_stats', (collection + '-' + k), v, mongo_db)
-
         # stats sizes
         self.submit('file_size', 'storage', db_stats['storageSize'], mongo_db)
         self.submit('file_size', 'index', db_stats['indexSize'], mongo_db)
         self.submit('file_size', 'data', db_stats['dataSize'], mongo_db)
 
-    def do_oplog_get_metrics(self, db):
-        self.do_get_replication_info_timestamps(db)
-        self.do_get_replication_info_stats(db)
+    def do_collection_stats(self, con, now):
+        databases = self.databases.names(con, self.mongo_db, now)
+        for (mongo_db, collection), cursor in self.collections.scan(con, databases, now):
+            for k, v in cursor:
+                self.submit('collection_stats', self.name('{0}-{1}', collection, k), v, mongo_db)
+
+    def do_index_stats(self, con, now):
+        databases = self.databases.names(con, self.mongo_db, now)
+        cache = self.indexes.cache
+        for mongo_db, collection in self.indexes.scan(con, databases, now):
+            for name, (since, ops, visited, rate, used) in sorted(cache[(mongo_db, collection)].items()):
+                if rate is not None:
+                    self.submit('index_ops', self.name('{0}-{1}', collection, name), rate, mongo_db)
+        counts = {}
+        for (mongo_db, collection), indexes in cache.items():
+            total, unused = counts.get(mongo_db, (0, 0))
+            counts[mongo_db] = (total + len(indexes), unused + self.indexes.unused(indexes, now))
+        for mongo_db, (total, unused) in sorted(counts.items()):
+            self.submit('index_usage', 'indexes', total, mongo_db)
+            self.submit('index_usage', 'unused', unused, mongo_db)
+
+    def do_top(self, db, now):
+        top = db.command('top')
+        for ns, categories in self.top.update(top['totals'], now):
+            for category, ops, latency in categories:
+                self.submit('top_ops', self.name('{0}-{1}', ns, category), ops)
+                self.submit('top_latency', self.name('{0}-{1}', ns, category), latency)
 
-    def do_get_replication_info_timestamps(self, db):
-        oplog_rs = db['oplog.rs']
-
-        oplog_head = oplog_rs.find(sort=[('$natural',1)], limit=1)[0]['ts']
-        oplog_tail = oplog_rs.find(sort=[('$natural',-1)], limit=1)[0]['ts']
-
-        self.submit_repl_info('', 'oplog', 'head_timestamp', oplog_head.time)
-        self.submit_repl_info('', 'oplog', 'tail_timestamp', oplog_tail.time)
-
-        self.submit_repl_info('', 'oplog', 'time_diff', int(oplog_tail.time - oplog_head.time))
-
-    def do_get_replication_info_stats(self, db):
-
-        oplog_info = db.command({ "collStats" : "oplog.rs" })
-
-        count = oplog_info['count']
-        self.submit_repl_info('', 'oplog', 'items_total', count)
-
-        size =  oplog_info['size']
-        self.submit_repl_info('', 'oplog', 'current_size_bytes', size)
-
-        storageSize = oplog_info['storageSize']
-        self.submit_repl_info('', 'oplog', 'storage_size_bytes', storageSize)
-
-        if 'maxSize' in oplog_info:
-            maxSize = oplog_info['maxSize']
-            logSizeMB = maxSize / (1024*1024)
-            self.submit_repl_info('', 'oplog', 'log_size_mb', logSizeMB)
-
-        usedMB = size / (1024 * 1024)
-        usedMB = math.ceil(usedMB * 100) / 100
-        self.submit_repl_info('', 'oplog', 'used_mb', usedMB)
-
-    def do_replset_get_status(self, db):
-
-        rs_status = db.command({"replSetGetStatus": 1})
-
-        rs_name = rs_status['set']
-
-        self.submit_repl_info(rs_name, 'my_state', 'value', rs_status['myState'])
-
-        if rs_status.has_key('term'):
-            self.submit_repl_info(rs_name, 'term', 'value', rs_status['term'])
-
-        if rs_status.has_key('heartbeatIntervalMillis'):
-            self.submit_repl_info(rs_name, 'hearbeat_interval_ms', 'value', rs_status['heartbeatIntervalMillis'])
-
-        primary_optime = None
-        self_optime = None
-        self_port = None
-
-        self.submit_repl_info(rs_name, 'member', 'count', len(rs_status['members']))
-
-        t = 'member'
-        for m in rs_status['members']:
-            is_primary = m['stateStr'] == 'PRIMARY'
-            is_self = m.has_key('self')
-
-            host, port = m['name'].split(":")
-            short_host = host.split(".")[0]
-            if is_self:
-                short_host = 'self'
-                self_port = port
-
-            n = "{0}-{1}".format(short_host, port)
-
-            if (not is_self) and re.match('\d+\.\d+\.\d+\.\d+', host):
-                n = "{0}-{1}".format(host,port)
-
-            self.submit_repl_info(rs_name, t, '{0}-uptime'.format(n), m['uptime'])
-            self.submit_repl_info(rs_name, t, '{0}-state'.format(n), m['state'])
-            self.submit_repl_info(rs_name, t, '{0}-health'.format(n), m['health'])
-
-            if m.has_key('electionTime'):
-                self.submit_repl_info(rs_name, 'member','{0}.election_time'.format(n), m['electionTime'].time)
-
-            if 'optime' in m:
-                if isinstance(m['optime'], dict):
-                    optime = m['optime']['ts'].time
-                else:
-                    optime = m['optime'].time
-
-                self.submit_repl_info(rs_name, t, '{0}-optime_date'.format(n), optime)
-
-                if is_primary:
-                    primary_optime = optime
-                if is_self:
-                    self_optime = optime
-
-            if m.has_key('lastHeartbeat'):
-                self.submit_repl_info(rs_name, t, '{0}-last_heartbeat'.format(n), tstofloat(m['lastHeartbeat']))
-
-            if m.has_key('lastHeartbeatRecv'):
-                self.submit_repl_info(rs_name, t, '{0}-last_heartbeat_recv'.format(n), tstofloat(m['lastHeartbeatRecv']))
-            if m.has_key('pingMs'):
-                self.submit_repl_info(rs_name, t, '{0}-ping_ms'.format(n), m['pingMs'])
+    def config(self, obj):
+        for node in obj.children:
+            if not self.config_node(node):
+                collectd.warning("mongodb plugin: Unkown configuration key %s" % node.key)
 
-        if self_optime != None and primary_optime != None:
-            n = "self-{0}".format(self_port)
-            self.submit_repl_info(rs_name, t, '{0}-replication_lag'.format(n), int(primary_optime - self_optime))
+    def config_node(self, node):
+        if node.key == 'Port':
+            self.mongo_port = int(node.values[0])
+        elif node.key == 'Host':
+            self.mongo_host = node.values[0]
+        elif node.key == 'User':
+            self.mongo_user = node.values[0]
+        elif node.key == 'Password':
+            self.mongo_password = node.values[0]
+        elif node.key == 'Database':
+            self.mongo_db = node.values
+        elif node.key == 'PluginInstance':
+            self.plugin_instance = node.values[0]
+        elif node.key == 'Timeout':
+            self.timeout = float(node.values[0])
+        elif node.key == 'Interval':
+            if node.values[0] not in COLLECTORS:
+                collectd.warning("mongodb plugin: Unknown collector %s" % node.values[0])
+            else:
+                self.schedule.set(node.values[0], float(node.values[1]))
+        elif node.key == 'IncludeMetric':
+            self.include_metrics = list(node.values)
+        elif node.key == 'ExcludeMetric':
+            self.exclude_metrics = list(node.values)
+        elif node.key == 'CollectionsPerInterval':
+            self.collections.budget = int(node.values[0])
+        elif node.key == 'CollectionListInterval':
+            self.collections.list_interval = float(node.values[0])
+        elif node.key == 'IncludeCollection':
+            self.collections.include = list(node.values)
+        elif node.key == 'ExcludeCollection':
+            self.collections.exclude = list(node.values)
+        elif node.key == 'IndexStatsPerInterval':
+            self.indexes.budget = int(node.values[0])
+        elif node.key == 'UnusedIndexHours':
+            self.indexes.unused_hours = float(node.values[0])
+        elif node.key == 'TopNamespaces':
+            self.top.size = int(node.values[0])
+        elif node.key == 'CurrentOpDatabases':
+            self.current_op_databases = int(node.values[0])
+        elif node.key == 'LagMatrix':
+            self.lags.enabled = bool(node.values[0])
+        elif node.key == 'LagWindow':
+            self.lags.window = int(node.values[0])
+        elif node.key == 'DiscoverDatabases':
+            self.databases.discover = bool(node.values[0])
+        elif node.key == 'DatabaseListInterval':
+            self.databases.list_interval = float(node.values[0])
+        elif node.key == 'IncludeDatabase':
+            self.databases.include = list(node.values)
+        elif node.key == 'ExcludeDatabase':
+            self.databases.exclude = list(node.values)
+        elif node.key == 'DatabaseWorkers':
+            self.database_workers = int(node.values[0])
+        elif node.key == 'DatabaseTimeout':
+            self.database_timeout = float(node.values[0])
+        elif node.key == 'SuppressUnchanged':
+            self.dispatcher.changes.enabled = bool(node.values[0])
+        elif node.key == 'SuppressRefresh':
+            self.dispatcher.changes.refresh = int(node.values[0])
+        elif node.key == 'RecordFile':
+            self.record_file = node.values[0]
+        elif node.key == 'RecordSize':
+            self.record_size = int(node.values[0])
+        elif node.key == 'LoadShedding':
+            self.shedder.enabled = bool(node.values[0])
+        elif node.key == 'SlowCommandLatency':
+            self.shedder.slow_latency = float(node.values[0])
+        elif node.key == 'SlowdownFactor':
+            self.shedder.slowdown_factor = float(node.values[0])
+        elif node.key == 'BreakerTimeouts':
+            self.shedder.breaker_timeouts = int(node.values[0])
+        elif node.key == 'BreakerDelay':
+            self.shedder.breaker_delay = float(node.values[0])
+        else:
+            return False
+        return True
+
+    def describe(self):
+        if self.plugin_instance:
+            return '%s (%s:%s)' % (self.plugin_instance, self.mongo_host, self.mongo_port)
+        return '%s:%s' % (self.mongo_host, self.mongo_port)
+
+    def compile_metrics(self):
+        self.server_status_metrics = MetricMap(SERVER_STATUS_METRICS, self.include_metrics, self.exclude_metrics)
+        self.server_status.require(*self.server_status_metrics.sections)
+        self.wired_tiger_metrics = MetricMap(WIRED_TIGER_METRICS, self.include_metrics, self.exclude_metrics)
+
+    def init(self):
+        self.compile_metrics()
+        self.database_pool = WorkerPool('mongodb-dbstats', max(1, self.database_workers))
+        self.database_pool.start()
+        if self.record_file:
+            self.stats.recorder = acquire_recorder(self.record_file, self.record_size << 20)
+            self.stats.target = '%s:%s' % (self.mongo_host, self.mongo_port)
+        self.server = acquire_server(self.mongo_host, self.mongo_port, self.mongo_user, self.mongo_password, self.timeout)
+        self.connection = self.server.connection
+        self.connection.get()
+
+    def shutdown(self):
+        if self.database_pool is not None:
+            self.database_pool.stop()
+            self.database_pool = None
+        if self.stats.recorder is not None:
+            release_recorder(self.stats.recorder)
+            self.stats.recorder = None
+        if self.server is not None:
+            release_server(self.server)
+            self.server = None
+
+
+def parse_shard_host(host):
+    """The members of a shard from its config.shards host, "rs/host:port,..." """
+    members = []
+    for address in host.split('/')[-1].split(','):
+        name, _, port = address.partition(':')
+        members.append((name, int(port or 27017)))
+    return members
+
+
+class Cluster(object):
+    """A sharded cluster polled through a mongos.
+
+    The shards and their members are read from config.shards through the
+    mongos every refresh_interval seconds, and every member is polled as a
+    target of its own, configured as the mongos target of the <Cluster>
+    block, with "<cluster>-<shard>-<host>-<port>" as plugin instance. The
+    mongos itself is polled for its serverStatus as "<cluster>-mongos".
+    Members which left the cluster are shut down once their last poll is
+    over.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.nodes = []
+        self.refresh_interval = DEFAULT_CLUSTER_REFRESH_INTERVAL
+        self.mongos = MongoDB()
+        self.mongos.plugin_instance = '%s-mongos' % name
+        self.members = {}
+        self.retired = []
+        self.refreshed = None
 
     def config(self, obj):
         for node in obj.children:
-            if node.key == 'Port':
-                self.mongo_port = int(node.values[0])
-            elif node.key == 'Host':
-                self.mongo_host = node.values[0]
-            elif node.key == 'User':
-                self.mongo_user = node.values[0]
-            elif node.key == 'Password':
-                self.mongo_password = node.values[0]
-            elif node.key == 'Database':
-                self.mongo_db = node.values
+            if node.key == 'RefreshInterval':
+                self.refresh_interval = float(node.values[0])
+            elif self.mongos.config_node(node):
+                if node.key != 'PluginInstance':
+                    self.nodes.append(node)
             else:
                 collectd.warning("mongodb plugin: Unkown configuration key %s" % node.key)
+        for collector in MONGOS_DISABLED_COLLECTORS:
+            self.mongos.schedule.set(collector, -1)
+
+    def targets(self):
+        return [self.mongos] + list(self.members.values())
+
+    def due(self, now):
+        return self.refreshed is None or now - self.refreshed >= self.refresh_interval
+
+    def member(self, shard, host, port):
+        target = MongoDB()
+        for node in self.nodes:
+            target.config_node(node)
+        target.mongo_host = host
+        target.mongo_port = port
+        target.plugin_instance = '%s-%s-%s' % (self.name, shard, host_label(host, port))
+        return target
+
+    def refresh(self, now):
+        con = self.mongos.connection.get() if self.mongos.connection is not None else None
+        if con is None:
+            return
+        members = {}
+        for shard in con['config']['shards'].find():
+            for host, port in parse_shard_host(shard['host']):
+                key = (shard['_id'], host, port)
+                members[key] = self.members.get(key) or self.member(shard['_id'], host, port)
+        self.retired.extend(t for key, t in self.members.items() if key not in members)
+        if set(members) != set(self.members):
+            collectd.info("mongodb plugin: cluster %s has %d shard members" % (self.name, len(members)))
+        self.members = members
+        self.refreshed = now
+
+
+class MongoDBPlugin(object):
+    """Polls one or more mongod targets concurrently from a single read callback.
+
+    Top level target keys (Host, Port, User, Database...) describe the
+    default target. Each <Instance "name"> block adds a target of its own,
+    and each <Cluster "name"> block the mongos and shard members of a sharded
+    cluster, inheriting every top level target key but PluginInstance; when
+    instances or clusters are configured the default target is not polled.
+
+    Polls only collect values; the read callback dispatches the newest
+    completed snapshot of every target. With BackgroundPoll enabled the polls
+    are driven by a thread of their own every PollInterval seconds and the
+    read callback never waits on the network.
+    """
 
-mongodb = MongoDB()
-collectd.register_read(mongodb.get_db_and_collection_stats)
-collectd.register_config(mongodb.config)
-
+    def __init__(self):
+        self.default = MongoDB()
+        self.targets = []
+        self.clusters = []
+        self.workers = DEFAULT_WORKERS
+        self.background = False
+        self.poll_interval = DEFAULT_POLL_INTERVAL
+        self.pool = None
+        self.poller = None
+        self.jobs = {}
+        self.starting = set()
 
+    def config(self, obj):
+        instances = []
+        clusters = []
+        inherited = []
+        for node in obj.children:
+            if node.key == 'Instance':
+                instances.append(node)
+            elif node.key == 'Cluster':
+                clusters.append(node)
+            elif node.key == 'Workers':
+                self.workers = int(node.values[0])
+            elif node.key == 'BackgroundPoll':
+                self.background = bool(node.values[0])
+            elif node.key == 'PollInterval':
+                self.poll_interval = float(node.values[0])
+            elif not self.default.config_node(node):
+                collectd.warning("mongodb plugin: Unkown configuration key %s" % node.key)
+            elif node.key != 'PluginInstance':
+                inherited.append(node)
+
+        for node in instances:
+            target = MongoDB()
+            for default in inherited:
+                target.config_node(default)
+            if node.values:
+                target.plugin_instance = node.values[0]
+            target.config(node)
+            self.targets.append(target)
+
+        for node in clusters:
+            cluster = Cluster(node.values[0])
+            for default in inherited:
+                cluster.mongos.config_node(default)
+            cluster.nodes.extend(inherited)
+            cluster.config(node)
+            self.clusters.append(cluster)
+
+        if not self.targets and not self.clusters:
+            self.targets.append(self.default)
+
+    def all_targets(self):
+        targets = list(self.targets)
+        for cluster in self.clusters:
+            targets.extend(cluster.targets())
+        return targets
+
+    def init(self):
+        # the members of a cluster are only known once discovered
+        workers = self.workers if self.clusters else min(self.workers, len(self.targets))
+        self.pool = WorkerPool('mongodb', max(1, workers))
+        self.pool.start()
+        for target in self.targets + [cluster.mongos for cluster in self.clusters]:
+            job = self.jobs[target] = self.pool.submit(target.init)
+            self.starting.add(job)
+        if self.background:
+            self.poller = BackgroundPoller('mongodb-poller', self.poll_interval, self.poll)
+            self.poller.start()
+
+    def discover(self, now):
+        for cluster in self.clusters:
+            for target in list(cluster.retired):
+                job = self.jobs.get(target)
+                if job is None or job.done.is_set():
+                    target.shutdown()
+                    cluster.retired.remove(target)
+                    self.jobs.pop(target, None)
+            job = self.jobs.get(cluster)
+            if cluster.due(now) and (job is None or job.done.is_set()):
+                self.jobs[cluster] = self.pool.submit(cluster.refresh, now)
+
+    def poll(self):
+        start = time.time()
+        self.discover(start)
+        polls = []
+        for target in self.all_targets():
+            job = self.jobs.get(target)
+            if job in self.starting:
+                # the first poll waits for the connection opened by init
+                self.starting.discard(job)
+                job.wait(start + target.timeout - time.time())
+            if job is not None and not job.done.is_set():
+                collectd.warning("mongodb plugin: %s is still busy with a previous poll, skipping" % target.describe())
+                continue
+            job = self.pool.submit(target.get_db_and_collection_stats)
+            self.jobs[target] = job
+            polls.append((target, job))
+
+        for target, job in polls:
+            if not job.wait(start + target.timeout - time.time()):
+                collectd.warning("mongodb plugin: polling %s did not complete within %.1fs" % (target.describe(), target.timeout))
+
+    def read(self):
+        if self.poller is None:
+            self.poll()
+        for target in self.all_targets():
+            target.flush()
+
+    def shutdown(self):
+        if self.poller is not None:
+            self.poller.stop()
+        if self.pool is not None:
+            self.pool.stop()
+        for target in self.all_targets():
+            target.shutdown()
+        for cluster in self.clusters:
+            for target in cluster.retired:
+                target.shutdown()
+
+mongodb = MongoDBPlugin()
+collectd.register_config(mongodb.config)
+collectd.register_init(mongodb.init)
+collectd.register_read(mongodb.read)
+collectd.register_shutdown(mongodb.shutdown)
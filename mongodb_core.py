@@ -0,0 +1,1820 @@
+#
+# Shared helpers for the MongoDB collectd plugins
+#
+
+import collectd
+from bson import BSON
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, NetworkTimeout, OperationFailure, PyMongoError, ServerSelectionTimeoutError
+from pymongo.read_preferences import ReadPreference
+
+import bisect
+import heapq
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import traceback
+from array import array
+from collections import deque
+from fnmatch import fnmatch
+from timeit import default_timer as timer
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+CONNECT_TIMEOUT_MS = 5000
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 300.0
+
+try:
+    NUMBER_TYPES = (int, long, float)
+except NameError:
+    NUMBER_TYPES = (int, float)
+
+# serverStatus sections excluded from the first request, before the reply
+# tells which sections the server has; chosen for their size
+SERVER_STATUS_LARGE_SECTIONS = [
+    'asserts', 'electionMetrics', 'flowControl', 'globalLock', 'locks',
+    'logicalSessionRecordCache', 'metrics', 'opLatencies', 'oplogTruncation',
+    'security', 'storageEngine', 'tcmalloc', 'transactions',
+    'transportSecurity', 'twoPhaseCommitCoordinator', 'wiredTiger',
+]
+
+# commands return undecoded replies, decoded apart to time the decoding
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+SELF_PLUGIN = 'mongodb_self'
+
+# load shedding modes and thresholds, see LoadShedder
+SHED_NORMAL = 0
+SHED_SLOW = 1
+SHED_OPEN = 2
+SHED_MODES = ['normal', 'slow', 'open']
+SHED_SLOW_LATENCY = 0.5
+SHED_LATENCY_WEIGHT = 0.3
+SHED_SLOWDOWN = 4
+SHED_BREAKER_TIMEOUTS = 3
+SHED_BREAKER_DELAY = 60.0
+SHED_BREAKER_MAX_DELAY = 900.0
+SHED_RECOVERY_POLLS = 3
+
+# `top` categories and the fields of a namespace's top entry they add up
+TOP_CATEGORIES = [
+    ('total', ['total']),
+    ('read', ['queries', 'getmore']),
+    ('write', ['insert', 'update', 'remove']),
+    ('lock', ['readLock', 'writeLock']),
+]
+TOP_OTHER = 'other'
+TOP_FIELDS = [(field, c) for c, (category, fields) in enumerate(TOP_CATEGORIES) for field in fields]
+
+# ring file of the raw replies, see ResponseRecorder: the header (magic, data
+# size, index slots, next sequence, head position), then the index slots
+# (sequence, position, time, length, target), then the data
+RECORD_MAGIC = b'MDBREC01'
+RECORD_HEADER = struct.Struct('<8sQQQQ')
+RECORD_SLOT = struct.Struct('<QQdI64s')
+RECORD_SLOT_RATIO = 2048
+RECORD_POLL = '#poll'
+RECORD_EMPTY = BSON.encode({})
+DEFAULT_RECORD_SIZE = 64
+
+# sizes of the BSON element values, by element type, skipped over by
+# bson_index: fixed, or a length prefix plus what it does not count
+BSON_BYTE = struct.Struct('<B')
+BSON_INT32 = struct.Struct('<i')
+BSON_FIXED_SIZES = {1: 8, 6: 0, 7: 12, 8: 1, 9: 8, 10: 0, 16: 4, 17: 8, 18: 8, 19: 16, 127: 0, 255: 0}
+BSON_PREFIXED_SIZES = {2: 4, 3: 0, 4: 0, 5: 5, 13: 4, 14: 4, 15: 0}
+BSON_DOCUMENT = 3
+
+# polls an unchanged gauge is held back for at most, see ChangeFilter
+SUPPRESS_REFRESH = 10
+
+# percentiles of the opLatencies histograms, see LatencyHistograms
+OP_LATENCY_PERCENTILES = [('p50', 0.50), ('p95', 0.95), ('p99', 0.99)]
+# lower bounds of the server's latency histogram buckets in microseconds:
+# powers of two up to 1024, then steps of 1.5 and 2 up to 2097152, then
+# powers of two again (OperationLatencyHistogram::kLowerBounds)
+OP_LATENCY_BUCKETS = ([0] + [2 ** i for i in range(1, 11)] +
+                      [b for i in range(11, 21) for b in (2 ** i, 3 * 2 ** (i - 1))] +
+                      [2 ** i for i in range(21, 41)])
+
+# lags of each member kept to fit its trend, see LagTracker
+DEFAULT_LAG_WINDOW = 6
+
+OPLOG_STATS_INTERVAL = 60.0
+OPLOG_HEAD_INTERVAL = 600.0
+OPLOG_FULL_RATIO = 0.95
+OPLOG_SAMPLES = 60
+
+
+def log_exception(plugin_name, message):
+    """Logs the exception being handled through collectd.error.
+
+    Errors raised by pymongo are logged with their message only, anything
+    else is a bug and comes with its traceback.
+    """
+    e = sys.exc_info()[1]
+    if isinstance(e, PyMongoError):
+        collectd.error("%s plugin: %s: %s" % (plugin_name, message, e))
+    else:
+        collectd.error("%s plugin: %s: %s" % (plugin_name, message, traceback.format_exc().rstrip()))
+
+
+def is_timeout(e):
+    return isinstance(e, (ExecutionTimeout, NetworkTimeout, ServerSelectionTimeoutError))
+
+
+def is_load_error(e):
+    """Errors telling that the server is struggling, as opposed to errors
+    in what was asked of it"""
+    return isinstance(e, (ConnectionFailure, ExecutionTimeout))
+
+
+def tstofloat(d):
+    return time.mktime(d.timetuple())
+
+
+IP_ADDRESS = re.compile(r'\d+\.\d+\.\d+\.\d+')
+
+
+class MongoConnection(object):
+    """Authenticated MongoClient kept alive across read intervals.
+
+    The client is opened once and reused by every poll. After a failed poll
+    the next call to get() pings the server before handing the client out
+    again; connection or authentication errors drop the client and further
+    attempts are delayed with an exponential backoff.
+    """
+
+    def __init__(self, plugin_name, host, port, user=None, password=None, timeout=None):
+        self.plugin_name = plugin_name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+
+        self.client = None
+        self.healthy = False
+        self.failures = 0
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        timeout_ms = int(self.timeout * 1000) if self.timeout else None
+        client = MongoClient(host=self.host, port=self.port,
+                             read_preference=ReadPreference.SECONDARY,
+                             connectTimeoutMS=timeout_ms or CONNECT_TIMEOUT_MS,
+                             serverSelectionTimeoutMS=timeout_ms or CONNECT_TIMEOUT_MS,
+                             socketTimeoutMS=timeout_ms)
+        try:
+            if self.user and self.password:
+                client['admin'].authenticate(self.user, self.password)
+            else:
+                client['admin'].command('ping')
+        except:
+            client.close()
+            raise
+        return client
+
+    def get(self):
+        with self.lock:
+            return self.get_client()
+
+    def get_client(self):
+        if self.client is not None and not self.healthy:
+            try:
+                self.client['admin'].command('ping')
+                self.healthy = True
+            except PyMongoError as e:
+                collectd.warning("%s plugin: health check of %s:%s failed: %s" % (self.plugin_name, self.host, self.port, e))
+                self.close()
+
+        if self.client is not None:
+            return self.client
+
+        now = time.time()
+        if now < self.next_attempt:
+            return None
+
+        try:
+            self.client = self.open()
+        except PyMongoError as e:
+            self.failures += 1
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** (self.failures - 1))
+            self.next_attempt = now + delay
+            collectd.error("%s plugin: unable to connect to %s:%s: %s (retrying in %ds)" % (self.plugin_name, self.host, self.port, e, delay))
+            return None
+
+        self.healthy = True
+        self.failures = 0
+        self.next_attempt = 0
+        return self.client
+
+    def failed(self):
+        self.healthy = False
+
+    def tighten(self, timeout):
+        """Lowers the timeout to `timeout` if it is shorter, reopening the
+        client with it"""
+        with self.lock:
+            if timeout is None or (self.timeout and self.timeout <= timeout):
+                return
+            self.timeout = timeout
+            self.close()
+            self.next_attempt = 0
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.healthy = False
+
+
+class Job(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        # when a worker took the job, None while it is queued
+        self.started = None
+        self.done = threading.Event()
+
+    def run(self):
+        self.started = timer()
+        try:
+            self.result = self.func(*self.args)
+        except:
+            log_exception('mongodb', 'job failed')
+        finally:
+            self.done.set()
+
+    def wait(self, timeout):
+        self.done.wait(max(0, timeout))
+        return self.done.is_set()
+
+
+class WorkerPool(object):
+    """Fixed number of daemon threads running submitted jobs.
+
+    Callers wait on each job with their own deadline; a job that overruns
+    keeps its worker busy but never blocks the caller.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.jobs = queue.Queue()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.size):
+            t = threading.Thread(target=self.work, name='%s-worker-%d' % (self.name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, func, *args):
+        job = Job(func, args)
+        self.jobs.put(job)
+        return job
+
+    def stop(self):
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join(1.0)
+        self.threads = []
+
+
+class Snapshot(object):
+    """Values collected by one poll, stamped with the time the poll started"""
+
+    def __init__(self, time, values):
+        self.time = time
+        self.values = values
+
+
+class ChangeFilter(object):
+    """Holds back the gauges whose value did not change since last dispatched.
+
+    The last value sent of every gauge identity (plugin, plugin instance,
+    type, type instance) is kept in an array, at the index the identity is
+    interned to, next to the number of snapshots it has been held back for;
+    an unchanged value is dispatched anyway once held back for `refresh` - 1
+    snapshots, so that series stay continuous. Types are looked up with
+    collectd.get_dataset(): COUNTER, DERIVE and ABSOLUTE data sources, and
+    types collectd does not know, always go through, as do the mongodb_self
+    values measuring the filter.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.refresh = SUPPRESS_REFRESH
+        self.index = {}
+        self.last = array('d')
+        self.held = array('i')
+        self.gauges = {}
+
+    def is_gauge(self, type):
+        gauge = self.gauges.get(type)
+        if gauge is None:
+            try:
+                gauge = all(ds[1] == collectd.DS_TYPE_GAUGE for ds in collectd.get_dataset(type))
+            except (AttributeError, TypeError):
+                gauge = False
+            self.gauges[type] = gauge
+        return gauge
+
+    def passes(self, key, type, value):
+        gauge = self.gauges.get(type)
+        if gauge is None:
+            gauge = self.is_gauge(type)
+        if not gauge:
+            return True
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.last)
+            self.last.append(value)
+            self.held.append(0)
+            return True
+        if value == self.last[i] and self.held[i] + 1 < self.refresh:
+            self.held[i] += 1
+            return False
+        self.last[i] = value
+        self.held[i] = 0
+        return True
+
+
+class Dispatcher(object):
+    """Dispatches whole snapshots through reusable template Values.
+
+    One collectd.Values is kept per (plugin, plugin_instance, type) across
+    polls; only the type instance, value and time are passed to dispatch().
+    Unchanged gauges are held back by `changes` when it is enabled.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.changes = ChangeFilter()
+
+    def template(self, plugin_name, plugin_instance, type):
+        key = (plugin_name, plugin_instance, type)
+        v = self.templates.get(key)
+        if v is None:
+            v = collectd.Values(plugin=plugin_name, plugin_instance=plugin_instance, type=type)
+            self.templates[key] = v
+        return v
+
+    def flush(self, snapshot):
+        """Returns the number of values dispatched and held back"""
+        t = snapshot.time
+        templates = self.templates
+        changes = self.changes if self.changes.enabled else None
+        skipped = 0
+        for plugin_name, plugin_instance, type, instance, value in snapshot.values:
+            if changes is not None and plugin_name != SELF_PLUGIN and not changes.passes((plugin_name, plugin_instance, type, instance), type, value):
+                skipped += 1
+                continue
+            v = templates.get((plugin_name, plugin_instance, type))
+            if v is None:
+                v = self.template(plugin_name, plugin_instance, type)
+            v.dispatch(type_instance=instance, values=(value, ), time=t)
+        return len(snapshot.values) - skipped, skipped
+
+
+class NameCache(object):
+    """Memoizes type instance strings so they are built once, not every poll"""
+
+    def __init__(self):
+        self.names = {}
+
+    def __call__(self, fmt, *parts):
+        key = (fmt, ) + parts
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = fmt.format(*parts)
+        return name
+
+    def lower(self, fmt, *parts):
+        key = (fmt, None) + parts
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = fmt.format(*[p.lower() for p in parts])
+        return name
+
+
+class PollStats(object):
+    """Where the time of a target's polls goes, reported as plugin mongodb_self.
+
+    Each poll records the time spent getting a connection, each command's
+    round trip and BSON decoding, each find, each collector's extraction
+    (its time minus the round trips it waited for) and the values it
+    produced, plus a running count of errors per collector. Dispatching
+    a poll happens after its values were collected, so its time, and the
+    values it sent and held back when unchanged values are suppressed, are
+    reported with the next poll. Collectors may run commands from several
+    threads. With a `recorder`, the raw replies are also recorded under
+    `target`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.commands = {}
+        self.values = {}
+        self.errors = {}
+        self.dispatch_time = None
+        self.dispatched = None
+        self.recorder = None
+        self.target = None
+        self.io_time = 0.0
+        self.round_trips = 0
+        self.round_trip_time = 0.0
+        self.name = NameCache()
+
+    def start(self):
+        self.times = {}
+        self.commands = {}
+        self.values = {}
+        self.io_time = 0.0
+        self.round_trips = 0
+        self.round_trip_time = 0.0
+
+    def add(self, stage, name, seconds):
+        key = (stage, name)
+        with self.lock:
+            self.times[key] = self.times.get(key, 0.0) + seconds
+
+    def error(self, name):
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def io(self, stage, name, seconds):
+        self.add(stage, name, seconds)
+        with self.lock:
+            self.io_time += seconds
+
+    def round_trip(self, stage, name, seconds):
+        self.io(stage, name, seconds)
+        with self.lock:
+            self.round_trips += 1
+            self.round_trip_time += seconds
+
+    def mean_round_trip(self):
+        if self.round_trips:
+            return self.round_trip_time / self.round_trips
+        return None
+
+    def command(self, db, command, *args, **kwargs):
+        raw = self.raw_command(db, command, *args, **kwargs)
+        start = timer()
+        reply = BSON(raw.raw).decode()
+        self.io('decode', command_name(command), timer() - start)
+        return reply
+
+    def raw_command(self, db, command, *args, **kwargs):
+        """Runs a command and returns its reply undecoded, see decode"""
+        name = command_name(command)
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+        start = timer()
+        raw = db.command(command, *args, codec_options=RAW_CODEC_OPTIONS, **kwargs)
+        self.round_trip('command', name, timer() - start)
+        if self.recorder is not None:
+            self.record(command_key(db.name, command, args, kwargs), raw.raw)
+        return raw
+
+    def decode(self, command, raw, paths):
+        """Decodes only the subdocuments at `paths`, lists of keys, of a raw
+        reply into a document of the same shape; the rest of the reply is
+        skipped over without being decoded"""
+        start = timer()
+        data = raw.raw
+        doc = {}
+        # the elements of each document on the paths, by name
+        indexes = {(): bson_index(data, 0)}
+        for path in paths:
+            index = indexes[()]
+            for i, k in enumerate(path[:-1]):
+                element = index.get(k.encode('utf-8'))
+                if element is None or element[0] != BSON_DOCUMENT:
+                    break
+                parent = tuple(path[:i + 1])
+                index = indexes.get(parent)
+                if index is None:
+                    index = indexes[parent] = bson_index(data, element[1])
+            else:
+                element = index.get(path[-1].encode('utf-8'))
+                if element is not None and element[0] == BSON_DOCUMENT:
+                    d = doc
+                    for k in path[:-1]:
+                        d = d.setdefault(k, {})
+                    d[path[-1]] = BSON(data[element[1]:element[1] + element[2]]).decode()
+        self.io('decode', command_name(command), timer() - start)
+        return doc
+
+    def record(self, key, raw):
+        if self.recorder is not None:
+            self.recorder.record(self.target, key, raw, time.time())
+
+    def collector(self, name, values, func, *args):
+        """Runs a collector appending to values, timing it and counting its errors"""
+        io_time = self.io_time
+        count = len(values)
+        start = timer()
+        try:
+            func(*args)
+        except:
+            self.error(name)
+            raise
+        finally:
+            elapsed = timer() - start
+            self.add('collector', name, elapsed)
+            # round trips run concurrently may add up to more than elapsed
+            self.add('extract', name, max(0.0, elapsed - (self.io_time - io_time)))
+            self.values[name] = len(values) - count
+
+    def report(self, submit, plugin_instance):
+        name = self.name
+        if self.dispatch_time is not None:
+            submit(SELF_PLUGIN, plugin_instance, 'self_time', 'dispatch', self.dispatch_time)
+        if self.dispatched is not None:
+            submit(SELF_PLUGIN, plugin_instance, 'self_values', 'dispatch-sent', self.dispatched[0])
+            submit(SELF_PLUGIN, plugin_instance, 'self_values', 'dispatch-skipped', self.dispatched[1])
+        for (stage, what), seconds in self.times.items():
+            submit(SELF_PLUGIN, plugin_instance, 'self_time', name('{0}-{1}', stage, what) if what else stage, seconds)
+        for command, count in self.commands.items():
+            submit(SELF_PLUGIN, plugin_instance, 'self_commands', command, count)
+        for collector, count in self.values.items():
+            submit(SELF_PLUGIN, plugin_instance, 'self_values', collector, count)
+        for collector, count in self.errors.items():
+            submit(SELF_PLUGIN, plugin_instance, 'self_errors', collector, count)
+
+
+class InstrumentedClient(object):
+    """MongoClient wrapper timing the commands and finds of a poll"""
+
+    def __init__(self, client, stats):
+        self.client = client
+        self.stats = stats
+
+    def __getitem__(self, name):
+        return InstrumentedDatabase(self.client[name], self.stats)
+
+
+class InstrumentedDatabase(object):
+
+    def __init__(self, db, stats):
+        self.db = db
+        self.stats = stats
+
+    def command(self, command, *args, **kwargs):
+        return self.stats.command(self.db, command, *args, **kwargs)
+
+    def raw_command(self, command, *args, **kwargs):
+        return self.stats.raw_command(self.db, command, *args, **kwargs)
+
+    def collection_names(self):
+        start = timer()
+        names = self.db.collection_names()
+        self.stats.round_trip('command', 'listCollections', timer() - start)
+        if self.stats.recorder is not None:
+            self.stats.record('%s.listCollections' % self.db.name, BSON.encode({'names': names}))
+        return names
+
+    def __getitem__(self, name):
+        return InstrumentedCollection(self.db[name], self.db.name, self.stats)
+
+
+class InstrumentedCollection(object):
+
+    def __init__(self, collection, db_name, stats):
+        self.collection = collection
+        self.db_name = db_name
+        self.stats = stats
+
+    def find(self, *args, **kwargs):
+        # read at once so the round trips are timed; the collectors only
+        # read single documents
+        start = timer()
+        documents = list(self.collection.find(*args, **kwargs))
+        self.stats.round_trip('find', self.collection.name, timer() - start)
+        if self.stats.recorder is not None:
+            key = find_key(self.db_name, self.collection.name, kwargs.get('sort'))
+            self.stats.record(key, BSON.encode({'documents': documents}))
+        return documents
+
+
+def command_name(command):
+    return command if isinstance(command, str) else next(iter(command))
+
+
+def command_key(db_name, command, args, kwargs):
+    """Name of a command in a recording: its database, its name, its
+    argument unless 1 and the names of its options, so that serverStatus
+    commands differing only by the sections excluded share a name"""
+    if isinstance(command, dict):
+        name = next(iter(command))
+        value = command[name]
+        options = dict(command)
+        del options[name]
+        options.update(kwargs)
+    else:
+        name, value, options = command, args[0] if args else 1, kwargs
+    parts = ['%s.%s' % (db_name, name)]
+    if value != 1:
+        parts.append(str(value))
+    parts.extend(sorted(k for k, v in options.items() if v and k != 'codec_options'))
+    return ' '.join(parts)
+
+
+def find_key(db_name, collection, sort):
+    return '%s.find %s%s' % (db_name, collection, ''.join(' %s:%s' % (k, d) for k, d in sort or []))
+
+
+def bson_index(data, start):
+    """Type, offset and size of the values of the BSON document at `start`
+    in data, by encoded name, read from the element headers without decoding
+    the values"""
+    index = {}
+    int32 = BSON_INT32.unpack_from
+    byte = BSON_BYTE.unpack_from
+    find = data.index
+    end = start + int32(data, start)[0] - 1
+    pos = start + 4
+    while pos < end:
+        type = byte(data, pos)[0]
+        name_end = find(b'\0', pos + 1)
+        name = data[pos + 1:name_end]
+        pos = name_end + 1
+        size = BSON_FIXED_SIZES.get(type)
+        if size is None:
+            if type in BSON_PREFIXED_SIZES:
+                size = int32(data, pos)[0] + BSON_PREFIXED_SIZES[type]
+            elif type == 11:
+                # regular expression: pattern and options cstrings
+                size = find(b'\0', find(b'\0', pos) + 1) + 1 - pos
+            elif type == 12:
+                # DBPointer: string and ObjectId
+                size = int32(data, pos)[0] + 16
+            else:
+                raise InvalidBSON('unknown element type %d' % type)
+        index[name] = (type, pos, size)
+        pos += size
+    return index
+
+
+class ResponseRecorder(object):
+    """Raw server replies kept in a fixed-size memory-mapped ring file.
+
+    The file holds a header, an index of `slots` entries and a data ring.
+    A record is its key (see command_key), a NUL byte and the reply's BSON,
+    appended at the head of the ring or at its start when it does not fit
+    before the end. Its index slot, the sequence number of the record modulo
+    the number of slots, gives its position in the ring, time, length and
+    target, so that records are selected by time and target without reading
+    the data. A record is valid until its slot or its bytes are reused, which
+    the sequence and head position of the header tell. The file is opened
+    and mapped once, and an existing ring of the same size is appended to;
+    writes go to the page cache, the mapping being flushed on close only.
+    """
+
+    def __init__(self, path, size=None, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        if readonly:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.size, self.slots, self.seq, self.head = RECORD_HEADER.unpack_from(self.map, 0)
+            if magic != RECORD_MAGIC:
+                self.close()
+                raise ValueError('%s is not a recording' % path)
+        else:
+            slots = max(1, size // RECORD_SLOT_RATIO)
+            total = RECORD_HEADER.size + slots * RECORD_SLOT.size + size
+            exists = os.path.exists(path) and os.path.getsize(path) == total
+            self.file = open(path, 'r+b' if exists else 'w+b')
+            if not exists:
+                self.file.truncate(total)
+            self.map = mmap.mmap(self.file.fileno(), total)
+            magic, previous_size, previous_slots, seq, head = RECORD_HEADER.unpack_from(self.map, 0)
+            if magic == RECORD_MAGIC and (previous_size, previous_slots) == (size, slots):
+                self.seq, self.head = seq, head
+            else:
+                self.seq, self.head = 1, 0
+            self.size, self.slots = size, slots
+            RECORD_HEADER.pack_into(self.map, 0, RECORD_MAGIC, self.size, self.slots, self.seq, self.head)
+        self.data = RECORD_HEADER.size + self.slots * RECORD_SLOT.size
+
+    def record(self, target, key, raw, t):
+        record = key.encode('utf-8') + b'\0' + raw
+        n = len(record)
+        if n > self.size:
+            return
+        with self.lock:
+            pos = self.head
+            offset = pos % self.size
+            if offset + n > self.size:
+                pos += self.size - offset
+                offset = 0
+            self.map[self.data + offset:self.data + offset + n] = record
+            RECORD_SLOT.pack_into(self.map, RECORD_HEADER.size + (self.seq % self.slots) * RECORD_SLOT.size,
+                                  self.seq, pos, t, n, target.encode('utf-8'))
+            self.seq += 1
+            self.head = pos + n
+            RECORD_HEADER.pack_into(self.map, 0, RECORD_MAGIC, self.size, self.slots, self.seq, self.head)
+
+    def records(self, target=None, since=None, until=None):
+        """Yields (time, target, key, raw) of the valid records, oldest first"""
+        found = []
+        for i in range(self.slots):
+            seq, pos, t, n, name = RECORD_SLOT.unpack_from(self.map, RECORD_HEADER.size + i * RECORD_SLOT.size)
+            if seq == 0 or seq < self.seq - self.slots or self.head - pos > self.size:
+                continue
+            if (since is not None and t < since) or (until is not None and t > until):
+                continue
+            name = name.rstrip(b'\0').decode('utf-8')
+            if target is None or name == target:
+                found.append((seq, pos, t, n, name))
+        found.sort()
+        for seq, pos, t, n, name in found:
+            start = self.data + pos % self.size
+            key, raw = self.map[start:start + n].split(b'\0', 1)
+            yield t, name, key.decode('utf-8'), raw
+
+    def close(self):
+        if self.map is not None:
+            if not self.readonly:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+RECORDERS = {}
+RECORDERS_LOCK = threading.Lock()
+
+
+def acquire_recorder(path, size):
+    """The recorder writing to `path`, shared by every plugin and target
+    recording to it; `size` is in bytes"""
+    with RECORDERS_LOCK:
+        entry = RECORDERS.get(path)
+        if entry is None:
+            entry = RECORDERS[path] = [ResponseRecorder(path, size), 0]
+        entry[1] += 1
+    return entry[0]
+
+
+def release_recorder(recorder):
+    with RECORDERS_LOCK:
+        entry = RECORDERS[recorder.path]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del RECORDERS[recorder.path]
+    recorder.close()
+
+
+class Replay(object):
+    """The replies of a recording served poll by poll in place of a server.
+
+    Records are grouped by target into the polls of `plugin` (the mongodb
+    plugin when it recorded, the mongodb_replset plugin otherwise), from one
+    of its poll marks to the next; the replies recorded by the other plugin
+    meanwhile belong to the same poll. client() stands in for MongoClient:
+    commands, collection listings and finds are answered with the reply
+    recorded under the same key in the current poll of the target, or fail
+    when there is none.
+    """
+
+    def __init__(self, path, plugin=None):
+        recorder = ResponseRecorder(path, readonly=True)
+        try:
+            records = list(recorder.records())
+        finally:
+            recorder.close()
+        marks = set(key for t, target, key, raw in records if key.startswith(RECORD_POLL))
+        if plugin is None:
+            plugin = 'mongodb' if '%s mongodb' % RECORD_POLL in marks else 'mongodb_replset'
+        mark = '%s %s' % (RECORD_POLL, plugin)
+        self.polls = {}
+        for t, target, key, raw in records:
+            polls = self.polls.setdefault(target, [])
+            if key == mark:
+                polls.append((t, {}))
+            elif polls and not key.startswith(RECORD_POLL):
+                polls[-1][1].setdefault(key, []).append(raw)
+        self.polls = dict((target, polls) for target, polls in self.polls.items() if polls)
+        self.current = {}
+        self.served = {}
+
+    def targets(self):
+        return sorted(self.polls)
+
+    def count(self):
+        return max([len(polls) for polls in self.polls.values()] or [0])
+
+    def start(self, i):
+        """Moves every target to its i-th poll; returns the time of the
+        earliest of them"""
+        times = []
+        self.served = {}
+        for target, polls in self.polls.items():
+            if i < len(polls):
+                times.append(polls[i][0])
+                self.current[target] = polls[i][1]
+            else:
+                self.current[target] = {}
+        return min(times) if times else None
+
+    def reply(self, target, key):
+        replies = self.current.get(target, {}).get(key)
+        if not replies:
+            raise OperationFailure('no reply recorded for %s on %s' % (key, target))
+        # replies recorded several times in a poll are served in turn
+        n = self.served.get((target, key), 0)
+        self.served[(target, key)] = n + 1
+        return replies[min(n, len(replies) - 1)]
+
+    def client(self, host=None, port=None, **kwargs):
+        return ReplayClient(self, '%s:%s' % (host, port))
+
+
+class ReplayClient(object):
+
+    def __init__(self, replay, target):
+        self.replay = replay
+        self.target = target
+
+    def __getitem__(self, name):
+        return ReplayDatabase(self, name)
+
+    def close(self):
+        pass
+
+
+class ReplayDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def authenticate(self, user, password):
+        return True
+
+    def command(self, command, *args, **kwargs):
+        codec_options = kwargs.pop('codec_options', None)
+        if command == 'ping':
+            return {'ok': 1.0}
+        raw = self.client.replay.reply(self.client.target, command_key(self.name, command, args, kwargs))
+        if codec_options is not None and codec_options.document_class is RawBSONDocument:
+            return RawBSONDocument(raw)
+        return BSON(raw).decode()
+
+    def collection_names(self):
+        raw = self.client.replay.reply(self.client.target, '%s.listCollections' % self.name)
+        return BSON(raw).decode()['names']
+
+    def __getitem__(self, name):
+        return ReplayCollection(self, name)
+
+
+class ReplayCollection(object):
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def find(self, *args, **kwargs):
+        key = find_key(self.db.name, self.name, kwargs.get('sort'))
+        return BSON(self.db.client.replay.reply(self.db.client.target, key)).decode()['documents']
+
+
+class BackgroundPoller(object):
+    """Daemon thread calling func every interval seconds until stopped"""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        next_run = time.time()
+        while not self.stopping.is_set():
+            try:
+                self.func()
+            except:
+                log_exception('mongodb', 'background poll failed')
+            next_run += self.interval
+            delay = next_run - time.time()
+            if delay < 0:
+                # fell behind: skip the missed runs instead of bursting
+                next_run = time.time()
+                delay = 0
+            self.stopping.wait(delay)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(self.interval)
+            self.thread = None
+
+
+class OplogTracker(object):
+    """Oplog window tracking without scanning local.oplog.rs every poll.
+
+    The tail is the last write optime the caller already fetched (from
+    serverStatus or replSetGetStatus), with a $natural scan as fallback. The
+    oplog collStats are refreshed every stats_interval seconds and the head
+    entry every head_interval seconds, or as soon as a stats refresh shows
+    the oplog filling up or being truncated.
+
+    Once the oplog is full its head moves along with its tail, so the window
+    measured at the last head refresh is kept rather than growing with the
+    tail. Each stats refresh adds a sample to a rolling history that gives
+    the growth rate and the window projected for the configured maxSize.
+    """
+
+    def __init__(self):
+        self.stats_interval = OPLOG_STATS_INTERVAL
+        self.head_interval = OPLOG_HEAD_INTERVAL
+
+        self.stats = None
+        self.stats_fetched = 0
+        self.head = None
+        self.head_fetched = 0
+        self.head_tail = None
+        self.tail = None
+        self.full = False
+        self.samples = deque(maxlen=OPLOG_SAMPLES)
+
+    def update(self, db, now, tail=None):
+        stale_head = self.head is None or now - self.head_fetched >= self.head_interval
+
+        if self.stats is None or now - self.stats_fetched >= self.stats_interval:
+            stats = db.command({"collStats": "oplog.rs"})
+            full = 'maxSize' in stats and stats['size'] >= stats['maxSize'] * OPLOG_FULL_RATIO
+            if full != self.full or (self.stats is not None and stats['size'] < self.stats['size']):
+                stale_head = True
+            self.stats = stats
+            self.stats_fetched = now
+            self.full = full
+            self.samples.append((now, stats['size']))
+
+        oplog_rs = db['oplog.rs']
+        if tail is None:
+            tail = oplog_rs.find(sort=[('$natural', -1)], limit=1)[0]['ts']
+        self.tail = tail
+
+        if stale_head:
+            self.head = oplog_rs.find(sort=[('$natural', 1)], limit=1)[0]['ts']
+            self.head_fetched = now
+            self.head_tail = tail
+
+    def window(self):
+        if self.full:
+            return self.head_tail.time - self.head.time
+        return self.tail.time - self.head.time
+
+    def growth_rate(self):
+        """Bytes appended to the oplog per second"""
+        if len(self.samples) > 1:
+            (first_time, first_size), (last_time, last_size) = self.samples[0], self.samples[-1]
+            sizes = [size for t, size in self.samples]
+            if last_size > first_size and sizes == sorted(sizes):
+                return float(last_size - first_size) / (last_time - first_time)
+        window = self.window()
+        if window > 0:
+            return float(self.stats['size']) / window
+        return None
+
+    def projected_window(self):
+        rate = self.growth_rate()
+        if not rate or 'maxSize' not in self.stats:
+            return None
+        return self.stats['maxSize'] / rate
+
+
+class TopTracker(object):
+    """Per-namespace rates and latencies between two `top` replies.
+
+    `top` returns cumulative operation counts and times (microseconds) for
+    every namespace of the server. Namespaces are interned to an index on
+    first sight, and each reply is kept as one array of counts and one of
+    times per category, indexed by namespace, -1 marking a namespace missing
+    from the reply. update() diffs a reply against the previous one and
+    returns the `size` namespaces which took the most time in between, plus
+    the sum of the others under TOP_OTHER, so that the number of values
+    stays bounded however many namespaces the server has.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.index = {}
+        self.names = []
+        self.counts = None
+        self.times = None
+        self.time = None
+
+    def intern(self, ns, counts, times):
+        i = self.index.get(ns)
+        if i is None:
+            i = self.index[ns] = len(self.names)
+            self.names.append(ns)
+            for a in counts + times:
+                a.append(-1.0)
+        return i
+
+    def compact(self, counts, times):
+        """Forgets the namespaces gone from the server; the previous reply
+        is dropped with them, so one interval goes without rates"""
+        live = [i for i in range(len(self.names)) if counts[0][i] >= 0]
+        self.names = [self.names[i] for i in live]
+        self.index = dict((ns, i) for i, ns in enumerate(self.names))
+        self.counts = self.times = None
+        return [array('d', [a[i] for i in live]) for a in counts], [array('d', [a[i] for i in live]) for a in times]
+
+    def parse(self, totals):
+        n = len(self.names)
+        counts = [array('d', [-1.0]) * n for c in TOP_CATEGORIES]
+        times = [array('d', [-1.0]) * n for c in TOP_CATEGORIES]
+        categories = range(len(TOP_CATEGORIES))
+        index = self.index
+        live = 0
+        for ns, entry in totals.items():
+            if not isinstance(entry, dict):
+                # "note"
+                continue
+            i = index.get(ns)
+            if i is None:
+                i = self.intern(ns, counts, times)
+            live += 1
+            row_counts = [0] * len(categories)
+            row_times = [0] * len(categories)
+            for field, c in TOP_FIELDS:
+                stat = entry.get(field)
+                if stat is not None:
+                    row_counts[c] += stat['count']
+                    row_times[c] += stat['time']
+            for c in categories:
+                counts[c][i] = row_counts[c]
+                times[c][i] = row_times[c]
+        if live * 2 < len(self.names):
+            counts, times = self.compact(counts, times)
+        return counts, times
+
+    def update(self, totals, now):
+        """Returns [(namespace, [(category, ops per second, mean latency in
+        microseconds), ...]), ...], empty on the first reply"""
+        counts, times = self.parse(totals)
+        previous_counts, previous_times = self.counts, self.times
+        elapsed = now - self.time if self.time is not None else 0
+        self.counts, self.times, self.time = counts, times, now
+        if previous_counts is None or elapsed <= 0:
+            return []
+
+        # deltas of the namespaces in both replies; counters going backwards
+        # (restart, namespace dropped and created again) count from zero
+        categories = range(len(TOP_CATEGORIES))
+        deltas = []
+        total_counts, total_times = counts[0], times[0]
+        previous_total = previous_times[0]
+        for i in range(len(previous_total)):
+            if total_counts[i] < 0 or previous_total[i] < 0:
+                continue
+            deltas.append((max(0.0, total_times[i] - previous_total[i]), i))
+        hottest = heapq.nlargest(self.size, deltas)
+        shown = set(i for d, i in hottest)
+
+        def delta(c, i):
+            return [max(0.0, counts[c][i] - previous_counts[c][i]), max(0.0, times[c][i] - previous_times[c][i])]
+
+        results = [(self.names[i], [delta(c, i) for c in categories]) for d, i in hottest]
+        if len(deltas) > len(shown):
+            other = []
+            for c in categories:
+                current_counts, current_times = counts[c], times[c]
+                last_counts, last_times = previous_counts[c], previous_times[c]
+                ops = t = 0.0
+                for d, i in deltas:
+                    if i in shown:
+                        continue
+                    x = current_counts[i] - last_counts[i]
+                    if x > 0:
+                        ops += x
+                    x = current_times[i] - last_times[i]
+                    if x > 0:
+                        t += x
+                other.append([ops, t])
+            results.append((TOP_OTHER, other))
+        return [(ns, [(TOP_CATEGORIES[c][0], ops / elapsed, t / ops if ops else 0.0) for c, (ops, t) in enumerate(sums)])
+                for ns, sums in results]
+
+
+class LatencyHistograms(object):
+    """Latency percentiles between two serverStatus opLatencies replies.
+
+    With `histograms: true`, each opLatencies category (reads, writes,
+    commands, transactions) comes with a cumulative histogram: the number of
+    operations whose latency fell in each bucket, listed by the lower bound
+    of the bucket in microseconds, empty buckets left out. The grid of
+    bounds is the server's OP_LATENCY_BUCKETS, so that a bucket ends at the
+    next bound of the server whether or not that bucket was ever reported,
+    and each reply is kept as one row of counts per category over the grid;
+    update() subtracts the previous rows to get the distribution of the
+    interval. Percentiles interpolate linearly within their bucket and the
+    max is the end of the highest bucket used.
+    """
+
+    def __init__(self):
+        self.bounds = []
+        self.index = {}
+        self.lower = self.upper = None
+        self.rows = {}
+        self.grow([[{'micros': b} for b in OP_LATENCY_BUCKETS]])
+
+    def grow(self, histograms):
+        """Adds the bounds not in the grid, which a server with other buckets
+        would report, moving the counts of the previous rows to their new
+        positions"""
+        new = set()
+        for histogram in histograms:
+            for bucket in histogram:
+                if bucket['micros'] not in self.index:
+                    new.add(int(bucket['micros']))
+        if not new:
+            return
+        old = self.bounds
+        self.bounds = sorted(set(old) | new)
+        self.index = dict((b, i) for i, b in enumerate(self.bounds))
+        self.lower = [float(b) for b in self.bounds]
+        # the last bucket is as wide as the step between the last two bounds
+        last = self.bounds[-1] * self.bounds[-1] // self.bounds[-2] if len(self.bounds) > 1 else 1
+        self.upper = [float(b) for b in self.bounds[1:] + [max(1, last)]]
+        for category, (counts, ops, latency) in self.rows.items():
+            row = [0.0] * len(self.bounds)
+            for b, c in zip(old, counts):
+                row[self.index[b]] = c
+            self.rows[category] = (row, ops, latency)
+
+    def update(self, op_latencies):
+        """Returns [(category, [(name, microseconds), ...]), ...] for the
+        categories which had operations since the previous reply, with the
+        names of OP_LATENCY_PERCENTILES followed by max and mean"""
+        sections = [(k, v) for k, v in sorted(op_latencies.items()) if isinstance(v, dict) and 'histogram' in v]
+        self.grow([section['histogram'] for category, section in sections])
+        results = []
+        for category, section in sections:
+            row = [0.0] * len(self.bounds)
+            for bucket in section['histogram']:
+                row[self.index[bucket['micros']]] = float(bucket['count'])
+            current = (row, section.get('ops', 0), section.get('latency', 0))
+            previous = self.rows.get(category)
+            self.rows[category] = current
+            if previous is None:
+                continue
+            # no operations, or counters reset by a restart
+            ops = current[1] - previous[1]
+            if ops <= 0:
+                continue
+            latencies = self.percentiles(current[0], previous[0])
+            if latencies is None:
+                continue
+            names = [name for name, q in OP_LATENCY_PERCENTILES] + ['max', 'mean']
+            results.append((category, list(zip(names, latencies + [float(current[2] - previous[2]) / ops]))))
+        return results
+
+    def percentiles(self, current, previous):
+        delta = [c - p for c, p in zip(current, previous)]
+        if min(delta) < 0:
+            return None
+        cumulative = []
+        total = 0.0
+        for d in delta:
+            total += d
+            cumulative.append(total)
+        if total <= 0:
+            return None
+        values = []
+        for name, q in OP_LATENCY_PERCENTILES:
+            rank = q * total
+            i = bisect.bisect_left(cumulative, rank)
+            fraction = (rank - (cumulative[i] - delta[i])) / delta[i]
+            values.append(self.lower[i] + fraction * (self.upper[i] - self.lower[i]))
+        top = max(i for i, d in enumerate(delta) if d > 0)
+        return values + [self.upper[top]]
+
+
+class Schedule(object):
+    """Independent intervals for the collectors run by a poll.
+
+    A collector with no interval runs on every poll, one with a negative
+    interval never runs. A collector is due when its next run falls within
+    half a poll period from now, so that intervals which are a multiple of
+    the poll period do not slip by a whole period because of jitter.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = dict(intervals)
+        self.next_run = {}
+        self.last_poll = None
+        self.period = 0
+
+    def set(self, name, interval):
+        self.intervals[name] = interval
+
+    def start(self, now):
+        self.period = now - self.last_poll if self.last_poll is not None else 0
+        self.last_poll = now
+        return now + self.period / 2
+
+    def due(self, name, now, horizon, slowdown=1, force=False):
+        """Whether a collector runs in this poll; a slowdown stretches its
+        interval, or the poll period when it runs on every poll. A forced
+        collector runs unless it never does, its next run counted from now"""
+        interval = self.intervals.get(name)
+        if interval is not None and interval < 0:
+            return False
+        if slowdown > 1:
+            interval = (interval or self.period) * slowdown
+        if not interval:
+            return True
+        if not force and horizon < self.next_run.get(name, 0):
+            return False
+        self.next_run[name] = now + interval
+        return True
+
+
+class LoadShedder(object):
+    """Backs off from a server struggling to answer the collectors.
+
+    Fed after each poll with the mean command round trip of the poll, the
+    connection errors and timeouts it met and whether expensive collectors
+    ran, it moves between three modes:
+
+    - normal: every collector runs on its schedule
+    - slow: the round trip average is above slow_latency, or a poll met
+      connection errors; the expensive collectors run `slowdown` times less
+      often. Back to normal once the average stayed under half slow_latency
+      for recovery_polls polls running expensive collectors without errors.
+    - open: the circuit breaker opened after breaker_timeouts timeouts with
+      no poll of the expensive collectors going through in between; those
+      stop while the cheap ones keep running. After breaker_delay seconds
+      one poll, the probe, runs every one of them whether due or not: when
+      they went through without timeouts the shedder goes back to slow,
+      otherwise the breaker stays open twice as long, up to
+      SHED_BREAKER_MAX_DELAY. The delay is kept when the breaker opens
+      again from slow, and starts over from breaker_delay once back to
+      normal.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.slow_latency = SHED_SLOW_LATENCY
+        self.slowdown_factor = SHED_SLOWDOWN
+        self.breaker_timeouts = SHED_BREAKER_TIMEOUTS
+        self.breaker_delay = SHED_BREAKER_DELAY
+        self.recovery_polls = SHED_RECOVERY_POLLS
+
+        self.mode = SHED_NORMAL
+        self.latency = None
+        self.timeouts = 0
+        self.healthy = 0
+        self.delay = None
+        self.reopen = 0
+        self.probing = False
+
+    def slowdown(self, now):
+        """The slowdown of the expensive collectors in this poll, None when
+        they must not run"""
+        if self.mode == SHED_NORMAL:
+            return 1
+        if self.mode == SHED_OPEN:
+            if now < self.reopen:
+                return None
+            self.probing = True
+        return self.slowdown_factor
+
+    def update(self, now, latency, errors, timeouts, expensive):
+        """Accounts for a poll; returns True when the mode changed"""
+        if not self.enabled:
+            return False
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += SHED_LATENCY_WEIGHT * (latency - self.latency)
+        if timeouts:
+            self.timeouts += timeouts
+        elif expensive:
+            self.timeouts = 0
+        mode = self.mode
+
+        if mode == SHED_OPEN:
+            if self.probing:
+                self.probing = False
+                if timeouts:
+                    self.delay = min(self.delay * 2, SHED_BREAKER_MAX_DELAY)
+                    self.reopen = now + self.delay
+                elif not expensive:
+                    # nothing went through to tell whether the server recovered
+                    self.reopen = now + self.delay
+                else:
+                    self.mode = SHED_SLOW
+                    self.timeouts = 0
+                    self.healthy = 0
+        elif self.timeouts >= self.breaker_timeouts:
+            self.mode = SHED_OPEN
+            self.delay = self.delay or self.breaker_delay
+            self.reopen = now + self.delay
+        elif errors or (self.latency is not None and self.latency > self.slow_latency):
+            self.mode = SHED_SLOW
+            self.healthy = 0
+        elif mode == SHED_SLOW and expensive and self.latency is not None and self.latency <= self.slow_latency / 2:
+            self.healthy += 1
+            if self.healthy >= self.recovery_polls:
+                self.mode = SHED_NORMAL
+                self.delay = None
+        return self.mode != mode
+
+
+class ServerStatusProjection(object):
+    """serverStatus command excluding the sections no collector reads.
+
+    serverStatus returns every default section unless told `section: 0`, and
+    which sections exist depends on the server version. The exclusions start
+    from a list of sections known to be large and are completed with every
+    unused section seen in a reply.
+    """
+
+    def __init__(self, sections=(), options=None):
+        self.sections = set()
+        self.excluded = set(SERVER_STATUS_LARGE_SECTIONS)
+        self.options = sorted((options or {}).items())
+        self.cmd = None
+        self.require(*sections)
+
+    def require(self, *sections):
+        self.sections.update(sections)
+        self.excluded.difference_update(sections)
+        self.cmd = None
+
+    def command(self):
+        if self.cmd is None:
+            self.cmd = SON([('serverStatus', 1)] + self.options + [(section, 0) for section in sorted(self.excluded)])
+        return self.cmd
+
+    def learn(self, reply):
+        self.learn_sections(k for k, v in reply.items() if isinstance(v, dict))
+
+    def learn_raw(self, raw):
+        self.learn_sections(k.decode('utf-8') for k, (type, pos, size) in bson_index(raw.raw, 0).items() if type == BSON_DOCUMENT)
+
+    def learn_sections(self, sections):
+        for k in sections:
+            if k not in self.sections and k not in self.excluded:
+                self.excluded.add(k)
+                self.cmd = None
+
+
+def is_number(v):
+    return isinstance(v, NUMBER_TYPES) and not isinstance(v, bool)
+
+
+class Metric(object):
+    """Maps the numbers found at a document path to a type and type instance.
+
+    `path` is dotted, with `*` matching any key at its level. `type` and
+    `instance` are formatted with the keys matched by the wildcards ({0},
+    {1}...), once renamed through `labels` and lowercased if `lower` is set.
+    Metrics with `default` unset are only collected when included by the
+    configuration.
+    """
+
+    def __init__(self, path, type, instance, default=True, lower=False, labels=None):
+        self.path = path
+        self.type = type
+        self.instance = instance
+        self.default = default
+        self.lower = lower
+        self.labels = labels or {}
+
+    def enabled(self, include=(), exclude=()):
+        if [p for p in exclude if fnmatch(self.path, p)]:
+            return False
+        return self.default or bool([p for p in include if fnmatch(self.path, p)])
+
+    def compile(self):
+        keys = self.path.split('.')
+        if '*' in keys:
+            return self.compile_wildcard(keys)
+
+        type = self.type
+        instance = self.instance
+
+        def extract(doc, submit):
+            v = doc
+            for k in keys:
+                if not isinstance(v, dict):
+                    return
+                v = v.get(k)
+            if is_number(v):
+                submit(type, instance, v)
+        return extract
+
+    def compile_wildcard(self, keys):
+        # the fixed keys before the first wildcard are looked up directly
+        first = keys.index('*')
+        prefix = keys[:first]
+        keys = keys[first:]
+        last = len(keys)
+        names = {}
+
+        def name(captures):
+            n = names.get(captures)
+            if n is None:
+                parts = [self.labels.get(c, c) for c in captures]
+                if self.lower:
+                    parts = [part.lower() for part in parts]
+                n = names[captures] = (self.type.format(*parts), self.instance.format(*parts))
+            return n
+
+        def walk(v, i, captures, submit):
+            if i == last:
+                if is_number(v):
+                    type, instance = name(captures)
+                    submit(type, instance, v)
+                return
+            if not isinstance(v, dict):
+                return
+            k = keys[i]
+            if k == '*':
+                for key, child in v.items():
+                    walk(child, i + 1, captures + (key, ), submit)
+            elif k in v:
+                walk(v[k], i + 1, captures, submit)
+
+        def extract(doc, submit):
+            v = doc
+            for k in prefix:
+                if not isinstance(v, dict):
+                    return
+                v = v.get(k)
+            walk(v, 0, (), submit)
+        return extract
+
+
+class MetricMap(object):
+    """Metric table compiled into one extractor per enabled metric.
+
+    Include and exclude are shell-style patterns matched against the
+    metric paths; `sections` lists the top level keys the enabled metrics
+    read.
+    """
+
+    def __init__(self, metrics, include=(), exclude=()):
+        enabled = [m for m in metrics if m.enabled(include, exclude)]
+        self.extractors = [m.compile() for m in enabled]
+        self.sections = sorted(set(m.path.split('.')[0] for m in enabled))
+
+    def extract(self, doc, submit):
+        for extract in self.extractors:
+            extract(doc, submit)
+
+
+class Server(object):
+    """A mongod shared by every plugin and target polling it.
+
+    The mongodb and mongodb_replset plugins share one connection and one
+    oplog tracker per server, and the documents they both read: a document
+    fetched by one of them is served to the others until it is older than
+    their max_age, half their poll period, so it is fetched once per
+    interval however many plugins read it. The connection uses the shortest
+    timeout asked for by its users.
+    """
+
+    def __init__(self, key, host, port, user=None, password=None, timeout=None):
+        self.key = key
+        self.connection = MongoConnection('mongodb', host, port, user, password, timeout)
+        self.oplog = OplogTracker()
+        self.oplog_lock = threading.Lock()
+        self.topology = Topology()
+        self.documents = {}
+        self.locks = {}
+        self.users = 0
+
+    def fetch(self, name, func, max_age):
+        with self.locks.setdefault(name, threading.Lock()):
+            now = time.time()
+            entry = self.documents.get(name)
+            if entry is not None and now - entry[0] < max_age:
+                return entry[1]
+            doc = func()
+            self.documents[name] = (now, doc)
+            return doc
+
+    def update_oplog(self, db, tail=None):
+        with self.oplog_lock:
+            self.oplog.update(db, time.time(), tail)
+
+
+SERVERS = {}
+SERVERS_LOCK = threading.Lock()
+
+
+def acquire_server(host, port, user=None, password=None, timeout=None):
+    key = (host, port, user)
+    with SERVERS_LOCK:
+        server = SERVERS.get(key)
+        if server is None:
+            server = SERVERS[key] = Server(key, host, port, user, password, timeout)
+        else:
+            server.connection.tighten(timeout)
+        server.users += 1
+    return server
+
+
+def release_server(server):
+    with SERVERS_LOCK:
+        server.users -= 1
+        if server.users > 0:
+            return
+        del SERVERS[server.key]
+    server.connection.close()
+
+
+def host_label(host, port):
+    """Short name of a server: its IP address or unqualified host name, and port"""
+    if IP_ADDRESS.match(host):
+        return '%s-%s' % (host, port)
+    return '%s-%s' % (host.split(".")[0], port)
+
+
+class Member(object):
+    """Identity of a replica set member and its type instance names"""
+
+    def __init__(self, m):
+        host, port = m['name'].split(":")
+        self.is_self = 'self' in m
+        if self.is_self:
+            label = 'self-%s' % port
+        else:
+            label = host_label(host, port)
+
+        self.label = label
+        self.uptime = label + '-uptime'
+        self.state = label + '-state'
+        self.health = label + '-health'
+        self.election_time = label + '.election_time'
+        self.optime_date = label + '-optime_date'
+        self.last_heartbeat = label + '-last_heartbeat'
+        self.last_heartbeat_recv = label + '-last_heartbeat_recv'
+        self.ping_ms = label + '-ping_ms'
+        self.replication_lag = label + '-replication_lag'
+        self.durable_lag = label + '-durable_lag'
+
+
+class Topology(object):
+    """Member identities of a replica set, cached across polls.
+
+    The members are only parsed again when the set name, term, or the
+    configVersion reported for this node change. Servers that report
+    neither are keyed on the members' names and self flags instead.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.members = []
+
+    def update(self, rs_status):
+        key = self.key_of(rs_status)
+        if key != self.key:
+            self.members = [Member(m) for m in rs_status['members']]
+            self.key = key
+        return self.members
+
+    def key_of(self, rs_status):
+        members = rs_status['members']
+        term = rs_status.get('term')
+        config_version = None
+        for m in members:
+            if 'self' in m:
+                config_version = m.get('configVersion')
+                break
+        if term is None or config_version is None:
+            return tuple((m['name'], 'self' in m) for m in members)
+        return (rs_status['set'], term, config_version, len(members))
+
+
+def optime_seconds(optime):
+    """Seconds of an optime, {ts, t} with protocol version 1 or a bare Timestamp"""
+    if isinstance(optime, dict):
+        optime = optime['ts']
+    return optime.time
+
+
+def lag_slope(samples):
+    """Least squares slope of (time, lag) samples, or None"""
+    n = len(samples)
+    if n < 2:
+        return None
+    mean_t = sum(t for t, lag in samples) / float(n)
+    mean_lag = sum(lag for t, lag in samples) / float(n)
+    var = sum((t - mean_t) ** 2 for t, lag in samples)
+    if not var:
+        return None
+    return sum((t - mean_t) * (lag - mean_lag) for t, lag in samples) / var
+
+
+class LagTracker(object):
+    """Replication lag of every member of a replica set, from one
+    replSetGetStatus.
+
+    A member's lag is how many seconds its applied and, when reported, its
+    durable optime are behind the applied optime of the primary. The last
+    `window` lags of each member are kept to fit the trend of its lag, in
+    seconds per second: positive while it falls behind, negative while it
+    catches up. Members gone from the set are forgotten.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = DEFAULT_LAG_WINDOW
+        self.samples = {}
+
+    def update(self, now, primary, optimes):
+        """Lags of [(member, applied, durable or None)] optimes, as
+        [(member, lag, durable lag or None, slope or None)]"""
+        samples = {}
+        lags = []
+        for member, applied, durable in optimes:
+            lag = max(0, primary - applied)
+            window = self.samples.get(member.label)
+            if window is None:
+                window = deque(maxlen=self.window)
+            if window and window[-1][0] == now:
+                # the same replSetGetStatus served again
+                window.pop()
+            window.append((now, lag))
+            samples[member.label] = window
+            durable_lag = max(0, primary - durable) if durable is not None else None
+            lags.append((member, lag, durable_lag, lag_slope(window)))
+        self.samples = samples
+        return lags
+
+
+class ReplicationStatus(object):
+    """replSetGetStatus and oplog emitters shared by both plugins.
+
+    Classes using it provide `server`, `max_age`, `last_write`, `lags` and
+    submit_repl_info(replset, type, instance, value).
+    """
+
+    def do_oplog_get_metrics(self, db):
+        self.server.update_oplog(db, self.last_write)
+        self.do_get_replication_info_timestamps(db)
+        self.do_get_replication_info_stats(db)
+
+    def do_get_replication_info_timestamps(self, db):
+        oplog_tail = self.server.oplog.tail
+        time_diff = int(self.server.oplog.window())
+
+        self.submit_repl_info('', 'oplog', 'head_timestamp', oplog_tail.time - time_diff)
+        self.submit_repl_info('', 'oplog', 'tail_timestamp', oplog_tail.time)
+
+        self.submit_repl_info('', 'oplog', 'time_diff', time_diff)
+
+    def do_get_replication_info_stats(self, db):
+
+        oplog_info = self.server.oplog.stats
+
+        count = oplog_info['count']
+        self.submit_repl_info('', 'oplog', 'items_total', count)
+
+        size =  oplog_info['size']
+        self.submit_repl_info('', 'oplog', 'current_size_bytes', size)
+
+        storageSize = oplog_info['storageSize']
+        self.submit_repl_info('', 'oplog', 'storage_size_bytes', storageSize)
+
+        if 'maxSize' in oplog_info:
+            maxSize = oplog_info['maxSize']
+            logSizeMB = maxSize / (1024*1024)
+            self.submit_repl_info('', 'oplog', 'log_size_mb', logSizeMB)
+
+        usedMB = size / (1024 * 1024)
+        usedMB = math.ceil(usedMB * 100) / 100
+        self.submit_repl_info('', 'oplog', 'used_mb', usedMB)
+
+        rate = self.server.oplog.growth_rate()
+        if rate is not None:
+            self.submit_repl_info('', 'oplog', 'growth_bytes_per_hour', rate * 3600)
+
+        projected = self.server.oplog.projected_window()
+        if projected is not None:
+            self.submit_repl_info('', 'oplog', 'projected_window_seconds', projected)
+
+    def do_replset_get_status(self, db):
+
+        rs_status = self.server.fetch('replSetGetStatus', lambda: db.command({"replSetGetStatus": 1}), self.max_age)
+
+        rs_name = rs_status['set']
+        submit = self.submit_repl_info
+
+        submit(rs_name, 'my_state', 'value', rs_status['myState'])
+
+        if 'term' in rs_status:
+            submit(rs_name, 'term', 'value', rs_status['term'])
+
+        if 'heartbeatIntervalMillis' in rs_status:
+            submit(rs_name, 'hearbeat_interval_ms', 'value', rs_status['heartbeatIntervalMillis'])
+
+        primary_optime = None
+        self_optime = None
+        self_member = None
+        optimes = []
+
+        members = rs_status['members']
+        submit(rs_name, 'member', 'count', len(members))
+
+        t = 'member'
+        for m, member in zip(members, self.server.topology.update(rs_status)):
+            submit(rs_name, t, member.uptime, m['uptime'])
+            submit(rs_name, t, member.state, m['state'])
+            submit(rs_name, t, member.health, m['health'])
+
+            if 'electionTime' in m:
+                submit(rs_name, t, member.election_time, m['electionTime'].time)
+
+            if 'optime' in m:
+                ts = m['optime']
+                if isinstance(ts, dict):
+                    ts = ts['ts']
+                optime = ts.time
+
+                submit(rs_name, t, member.optime_date, optime)
+
+                if m['stateStr'] == 'PRIMARY':
+                    primary_optime = optime
+                if member.is_self:
+                    self_optime = optime
+                    self_member = member
+                    self.last_write = ts
+
+                if self.lags.enabled:
+                    # this node reports its own durable optime apart
+                    durable = m.get('optimeDurable')
+                    if durable is None and member.is_self:
+                        durable = rs_status.get('optimes', {}).get('durableOpTime')
+                    optimes.append((member, optime, optime_seconds(durable) if durable is not None else None))
+
+            if 'lastHeartbeat' in m:
+                submit(rs_name, t, member.last_heartbeat, tstofloat(m['lastHeartbeat']))
+
+            if 'lastHeartbeatRecv' in m:
+                submit(rs_name, t, member.last_heartbeat_recv, tstofloat(m['lastHeartbeatRecv']))
+            if 'pingMs' in m:
+                submit(rs_name, t, member.ping_ms, m['pingMs'])
+
+        if self.lags.enabled:
+            # every member's lag, as seen from this node
+            if primary_optime is not None:
+                now = tstofloat(rs_status['date']) if 'date' in rs_status else time.time()
+                for member, lag, durable_lag, slope in self.lags.update(now, primary_optime, optimes):
+                    submit(rs_name, t, member.replication_lag, lag)
+                    if durable_lag is not None:
+                        submit(rs_name, t, member.durable_lag, durable_lag)
+                    if slope is not None:
+                        submit(rs_name, 'member_trend', member.replication_lag, slope)
+        elif self_optime != None and primary_optime != None:
+            submit(rs_name, t, self_member.replication_lag, int(primary_optime - self_optime))
@@ -0,0 +1,480 @@
+#
+# Standalone exporter running the MongoDB plugins without collectd
+#
+# Loads mongodb.py (and optionally mongodb_replset.py) on top of a collectd
+# module shim, drives their config, init, read and shutdown callbacks as
+# collectd would, and serves the latest values over HTTP in the Prometheus
+# text format and/or pushes them to Graphite in its plaintext format.
+#
+#   python mongodb_exporter.py --target db1:27017 --target db2:27017 --listen :9216
+#   python mongodb_exporter.py --target db1:27017 --replset --graphite carbon:2003
+#   python mongodb_exporter.py --target db1:27017 --option "Interval top 60" --once
+#   python mongodb_exporter.py --replay /var/tmp/mongodb.rec
+#
+# With --replay, the replies recorded by the plugins' RecordFile are fed
+# through the same collectors instead of polling servers, one read per
+# recorded poll on a clock set to the time of that poll.
+#
+
+import argparse
+import logging
+import math
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+import types
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+DEFAULT_INTERVAL = 10.0
+DEFAULT_LISTEN = ':9216'
+DEFAULT_EXPIRE = 900.0
+DEFAULT_GRAPHITE_PREFIX = 'collectd.'
+
+# the plugin's own types.db, then collectd's for its standard types
+TYPES_DB = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'types.db'),
+    '/usr/share/collectd/types.db',
+]
+
+# collectd.DS_TYPE_* constants
+DS_TYPES = {'COUNTER': 0, 'GAUGE': 1, 'DERIVE': 2, 'ABSOLUTE': 3}
+
+# --option keys also given to the mongodb_replset plugin
+REPLSET_OPTIONS = ['LagMatrix', 'LagWindow', 'RecordFile', 'RecordSize', 'SuppressUnchanged', 'SuppressRefresh', 'Timeout']
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRIC_NAME = re.compile(r'[^a-zA-Z0-9_:]')
+GRAPHITE_NAME = re.compile(r'[^a-zA-Z0-9_\-]')
+
+log = logging.getLogger('mongodb_exporter')
+
+
+def load_types(paths):
+    """Data source types of the types.db files, by type name"""
+    ds_types = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                fields = line.split(None, 1)
+                if len(fields) < 2 or fields[0].startswith('#'):
+                    continue
+                ds_types.setdefault(fields[0], fields[1].split(',')[0].strip().split(':')[1])
+    return ds_types
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Exposition(object):
+    """Latest value of every series dispatched, rendered once per poll.
+
+    Values dispatched by the plugins are stored by identity (plugin, plugin
+    instance, type, type instance); render() builds the Prometheus text
+    exposition of those updated within `expire` seconds into a buffer which
+    scrapes write out as is. The family and sample prefix of a series are
+    built on its first dispatch and reused by every render. With `updates`,
+    the series dispatched since the last pop_updated() are kept for pushing.
+    """
+
+    def __init__(self, ds_types, expire=DEFAULT_EXPIRE, updates=False):
+        self.ds_types = ds_types
+        self.expire = expire
+        self.series = {}
+        self.samples = {}
+        self.families = {}
+        self.updated = [] if updates else None
+        self.text = b''
+
+    def add(self, plugin, plugin_instance, type, type_instance, value, t):
+        key = (plugin, plugin_instance, type, type_instance)
+        if key not in self.samples:
+            self.samples[key] = self.sample(key)
+        self.series[key] = (value, t)
+        if self.updated is not None:
+            self.updated.append(key)
+
+    def sample(self, key):
+        plugin, plugin_instance, type, type_instance = key
+        name = METRIC_NAME.sub('_', '%s_%s' % (plugin, type))
+        ds_type = self.ds_types.get(type)
+        if ds_type in ('COUNTER', 'DERIVE'):
+            name, kind = name + '_total', 'counter'
+        elif ds_type is not None:
+            kind = 'gauge'
+        else:
+            kind = 'untyped'
+        if name not in self.families:
+            self.families[name] = '# HELP %s collectd %s plugin, type %s\n# TYPE %s %s' % (name, plugin, type, name, kind)
+        labels = ','.join('%s="%s"' % (label, escape_label(value)) for label, value in
+                          [('plugin_instance', plugin_instance), ('type_instance', type_instance)] if value)
+        return name, '%s{%s} ' % (name, labels) if labels else name + ' '
+
+    def render(self, now):
+        families = {}
+        for key, (value, t) in list(self.series.items()):
+            if t < now - self.expire:
+                del self.series[key]
+                del self.samples[key]
+                continue
+            name, prefix = self.samples[key]
+            families.setdefault(name, []).append(prefix + format_value(value))
+        lines = []
+        for name in sorted(families):
+            lines.append(self.families[name])
+            lines.extend(sorted(families[name]))
+        self.text = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+
+    def pop_updated(self):
+        updated, self.updated = self.updated, []
+        return updated
+
+
+class GraphitePusher(object):
+    """Sends the values dispatched since the previous push to Graphite.
+
+    Paths follow collectd's write_graphite plugin,
+    <prefix><host>.<plugin>[-<plugin_instance>].<type>[-<type_instance>],
+    dots within each part replaced by underscores. The connection is kept
+    across pushes and opened again on the next push after an error; values
+    which could not be sent are dropped.
+    """
+
+    def __init__(self, address, prefix=DEFAULT_GRAPHITE_PREFIX, host=None, timeout=5.0):
+        self.address = address
+        self.prefix = prefix
+        self.host = GRAPHITE_NAME.sub('_', host or socket.gethostname())
+        self.timeout = timeout
+        self.paths = {}
+        self.sock = None
+
+    def path(self, key):
+        plugin, plugin_instance, type, type_instance = [GRAPHITE_NAME.sub('_', str(p)) if p else '' for p in key]
+        return '%s%s.%s%s.%s%s' % (self.prefix, self.host, plugin, '-' + plugin_instance if plugin_instance else '',
+                                   type, '-' + type_instance if type_instance else '')
+
+    def push(self, exposition):
+        lines = []
+        series = exposition.series
+        for key in exposition.pop_updated():
+            entry = series.get(key)
+            if entry is None:
+                continue
+            path = self.paths.get(key)
+            if path is None:
+                path = self.paths[key] = self.path(key)
+            lines.append('%s %s %d\n' % (path, format_value(entry[0]), entry[1]))
+        if not lines:
+            return
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, self.timeout)
+            self.sock.sendall(''.join(lines).encode('utf-8'))
+        except (socket.error, socket.timeout) as e:
+            log.warning("sending %d values to graphite at %s:%s failed: %s", len(lines), self.address[0], self.address[1], e)
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        text = self.server.exposition.text
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exposition):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.exposition = exposition
+
+
+class ConfigNode(object):
+    """A configuration block as collectd hands it to config callbacks"""
+
+    def __init__(self, key, values=(), children=()):
+        self.key = key
+        self.values = tuple(values)
+        self.children = list(children)
+
+
+def install_shim(exposition):
+    """Installs a collectd module dispatching values to `exposition`; the
+    register functions record the callbacks in shim.registered"""
+    shim = types.ModuleType('collectd')
+    shim.registered = {}
+
+    class Values(object):
+
+        def __init__(self, **kwargs):
+            self.plugin = None
+            self.plugin_instance = None
+            self.type = None
+            self.type_instance = None
+            self.time = 0
+            self.values = []
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+
+        def dispatch(self, **kwargs):
+            t = kwargs.get('time', self.time) or time.time()
+            for value in kwargs.get('values', self.values):
+                exposition.add(kwargs.get('plugin', self.plugin), kwargs.get('plugin_instance', self.plugin_instance),
+                               kwargs.get('type', self.type), kwargs.get('type_instance', self.type_instance), value, t)
+
+    def register(kind):
+        def register_callback(func, *args, **kwargs):
+            shim.registered.setdefault(kind, []).append(func)
+        return register_callback
+
+    def get_dataset(name):
+        ds_type = exposition.ds_types.get(name)
+        if ds_type is None:
+            raise TypeError("Dataset %s not found" % name)
+        return [('value', DS_TYPES[ds_type], None, None)]
+
+    shim.Values = Values
+    shim.get_dataset = get_dataset
+    for ds_type, value in DS_TYPES.items():
+        setattr(shim, 'DS_TYPE_' + ds_type, value)
+    shim.debug = log.debug
+    shim.info = log.info
+    shim.notice = log.info
+    shim.warning = log.warning
+    shim.error = log.error
+    for kind in ['config', 'init', 'read', 'write', 'flush', 'shutdown']:
+        setattr(shim, 'register_' + kind, register(kind))
+    sys.modules['collectd'] = shim
+    return shim
+
+
+class ReplayClock(object):
+    """Stands in for the time module of the plugins during a replay"""
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def replay_polls(replay, clock, plugins, exposition, graphite):
+    """Runs one read per recorded poll, at the time it was recorded, and
+    prints the exposition of the last one"""
+    for i in range(replay.count()):
+        clock.now = replay.start(i)
+        for plugin, config in plugins:
+            plugin.call('read')
+        exposition.render(clock.now)
+        if graphite is not None:
+            graphite.push(exposition)
+    log.info("replayed %d polls of %s", replay.count(), ', '.join(replay.targets()))
+    sys.stdout.write(exposition.text.decode('utf-8'))
+
+
+class Plugin(object):
+    """A plugin module loaded on the shim, with the callbacks it registered"""
+
+    def __init__(self, shim, name):
+        self.name = name
+        shim.registered = {}
+        __import__(name)
+        self.callbacks = shim.registered
+
+    def call(self, kind, *args):
+        for func in self.callbacks.get(kind, []):
+            try:
+                func(*args)
+            except Exception:
+                log.exception("%s %s callback failed", self.name, kind)
+
+
+def parse_value(value):
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_address(address, default_port):
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return address, default_port
+    return host, int(port)
+
+
+def parse_target(spec):
+    """[name=]host[:port] to (name, host, port)"""
+    name, sep, address = spec.rpartition('=')
+    host, port = parse_address(address, 27017)
+    return name or None, host, port
+
+
+def server_nodes(host, port, args):
+    nodes = [ConfigNode('Host', [host]), ConfigNode('Port', [float(port)])]
+    if args.user:
+        nodes += [ConfigNode('User', [args.user]), ConfigNode('Password', [args.password or ''])]
+    return nodes
+
+
+def option_nodes(args):
+    return [ConfigNode(option.split()[0], [parse_value(v) for v in option.split()[1:]]) for option in args.option]
+
+
+def mongodb_config(args):
+    """The <Module mongodb> block equivalent to the command line"""
+    children = option_nodes(args)
+    targets = [parse_target(spec) for spec in args.target]
+    if len(targets) == 1 and targets[0][0] is None and not args.cluster:
+        children += server_nodes(targets[0][1], targets[0][2], args)
+    else:
+        if args.user:
+            children += [ConfigNode('User', [args.user]), ConfigNode('Password', [args.password or ''])]
+        for name, host, port in targets:
+            instance = [ConfigNode('Host', [host]), ConfigNode('Port', [float(port)])]
+            children.append(ConfigNode('Instance', [name or '%s-%s' % (host, port)], instance))
+        for spec in args.cluster:
+            name, host, port = parse_target(spec)
+            cluster = [ConfigNode('Host', [host]), ConfigNode('Port', [float(port)])]
+            children.append(ConfigNode('Cluster', [name or host], cluster))
+    return ConfigNode('Module', ['mongodb'], children)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exports the metrics of the MongoDB collectd plugins without collectd')
+    parser.add_argument('--target', action='append', default=[], metavar='[NAME=]HOST[:PORT]',
+                        help='server to poll; can be given several times')
+    parser.add_argument('--cluster', action='append', default=[], metavar='NAME=HOST[:PORT]',
+                        help='sharded cluster to poll through one of its mongos; can be given several times')
+    parser.add_argument('--user', help='user to authenticate as')
+    parser.add_argument('--password', help='password of the user')
+    parser.add_argument('--option', action='append', default=[], metavar='"KEY VALUE..."',
+                        help='any other mongodb plugin configuration key, e.g. "Interval top 60"')
+    parser.add_argument('--replset', action='store_true', help='also run the mongodb_replset plugin on the first target')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between two polls')
+    parser.add_argument('--listen', default=DEFAULT_LISTEN, metavar='[ADDRESS]:PORT',
+                        help='address to serve /metrics on, "" to disable')
+    parser.add_argument('--graphite', metavar='HOST[:PORT]', help='Graphite server to push the values to')
+    parser.add_argument('--graphite-prefix', default=DEFAULT_GRAPHITE_PREFIX, help='prefix of the Graphite paths')
+    parser.add_argument('--types-db', action='append', default=[], metavar='FILE', help='additional types.db files')
+    parser.add_argument('--expire', type=float, default=DEFAULT_EXPIRE,
+                        help='seconds after which a series no longer dispatched is dropped')
+    parser.add_argument('--once', action='store_true', help='poll once, print the exposition and exit')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay the replies recorded in FILE, by default for every target recorded')
+    parser.add_argument('--verbose', action='store_true', help='log debug messages')
+    args = parser.parse_args(argv)
+    if not args.target and not args.cluster and not args.replay:
+        parser.error('at least one --target or --cluster is required')
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    exposition = Exposition(load_types(TYPES_DB + args.types_db), args.expire, updates=bool(args.graphite))
+    shim = install_shim(exposition)
+
+    replay = clock = None
+    if args.replay:
+        import mongodb_core
+        replay = mongodb_core.Replay(args.replay)
+        mongodb_core.MongoClient = replay.client
+        if not args.target:
+            args.target = replay.targets()
+        args.cluster = []
+        clock = ReplayClock(replay.start(0))
+
+    plugins = [(Plugin(shim, 'mongodb'), mongodb_config(args))]
+    if args.replset:
+        name, host, port = parse_target((args.target or args.cluster)[0])
+        children = server_nodes(host, port, args) + [node for node in option_nodes(args) if node.key in REPLSET_OPTIONS]
+        plugins.append((Plugin(shim, 'mongodb_replset'), ConfigNode('Module', ['mongodb_replset'], children)))
+    if clock is not None:
+        for name in ['mongodb_core', 'mongodb', 'mongodb_replset']:
+            if name in sys.modules:
+                sys.modules[name].time = clock
+    for plugin, config in plugins:
+        plugin.call('config', config)
+    for plugin, config in plugins:
+        plugin.call('init')
+
+    server = graphite = None
+    if args.listen and not args.once and not args.replay:
+        server = MetricsServer(parse_address(args.listen, 9216), exposition)
+        thread = threading.Thread(target=server.serve_forever, name='mongodb-exporter-http')
+        thread.daemon = True
+        thread.start()
+        log.info("serving metrics on http://%s:%s/metrics", *server.server_address[:2])
+    if args.graphite:
+        graphite = GraphitePusher(parse_address(args.graphite, 2003), args.graphite_prefix)
+
+    # collectd-like shutdown of the plugins on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if replay is not None:
+            replay_polls(replay, clock, plugins, exposition, graphite)
+        while replay is None:
+            start = time.time()
+            for plugin, config in plugins:
+                plugin.call('read')
+            exposition.render(time.time())
+            if graphite is not None:
+                graphite.push(exposition)
+            if args.once:
+                sys.stdout.write(exposition.text.decode('utf-8'))
+                break
+            time.sleep(max(0.0, start + args.interval - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+        if graphite is not None:
+            graphite.close()
+        for plugin, config in plugins:
+            plugin.call('shutdown')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#
+# Timeouts of the concurrent dbstats of the db_status collector, against the
+# benchmarks' fake MongoClient answering dbstats slowly
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import harness
+import fake_client
+
+mongodb, mongodb_replset = harness.load_plugins()
+
+DATABASES = 42
+WORKERS = 4
+
+
+class SlowDbStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.delays = {}
+        command = self.command = fake_client.Database.command
+        delays = self.delays
+
+        def slow_command(db, name, *args, **kwargs):
+            if name == 'dbstats':
+                time.sleep(delays.get(db.name, delays.get(None, 0)))
+            return command(db, name, *args, **kwargs)
+
+        fake_client.Database.command = slow_command
+        fake_client.install(fake_client.Replies(tenants=DATABASES - 2))
+        self.target = None
+
+    def tearDown(self):
+        fake_client.Database.command = self.command
+        if self.target is not None:
+            self.target.shutdown()
+
+    def start(self, database_timeout, timeout):
+        t = self.target = mongodb.MongoDB()
+        t.mongo_db = ['admin', 'app']
+        t.databases.discover = True
+        t.database_workers = WORKERS
+        t.database_timeout = database_timeout
+        t.timeout = timeout
+        t.init()
+        return t
+
+    def poll(self):
+        """Returns the plugin instances of the databases reported and the
+        load errors and timeouts counted"""
+        t = self.target
+        t.get_db_and_collection_stats()
+        return set(v[1] for v in t.values if v[2] == 'file_size'), t.database_errors, t.database_timeouts
+
+    def test_queued_dbstats_do_not_time_out(self):
+        # each dbstats stays well under DatabaseTimeout, but all of them
+        # together take twice as long on the workers
+        self.delays[None] = 0.05
+        self.start(0.25, 2.0)
+        for i in range(2):
+            reported, errors, timeouts = self.poll()
+            self.assertEqual((len(reported), errors, timeouts), (DATABASES, 0, 0))
+        self.assertEqual(self.target.shedder.timeouts, 0)
+
+    def test_slow_dbstats_times_out(self):
+        self.delays['app'] = 0.5
+        self.start(0.2, 2.0)
+        reported, errors, timeouts = self.poll()
+        self.assertEqual((len(reported), errors, timeouts), (DATABASES - 1, 1, 1))
+        # skipped while its dbstats still runs, without counting it again
+        reported, errors, timeouts = self.poll()
+        self.assertEqual((len(reported), errors, timeouts), (DATABASES - 1, 0, 0))
+
+    def test_dbstats_left_by_the_poll_reported_next(self):
+        # the poll runs out of time before every dbstats completed
+        self.delays[None] = 0.05
+        self.start(1.0, 0.2)
+        first, errors, timeouts = self.poll()
+        self.assertTrue(len(first) < DATABASES)
+        self.assertEqual((errors, timeouts), (0, 0))
+        time.sleep(DATABASES * 0.05 / WORKERS)
+        second, errors, timeouts = self.poll()
+        self.assertEqual(len(first | second), DATABASES)
+        self.assertEqual((errors, timeouts), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#
+# Mode transitions of the load shedder and the forced runs of its probes
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mongodb_core import LoadShedder, Schedule
+from mongodb_core import SHED_BREAKER_MAX_DELAY, SHED_NORMAL, SHED_OPEN, SHED_SLOW
+
+FAST = 0.01
+SLOW = 1.0
+
+
+class LoadShedderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shedder = LoadShedder()
+        self.now = 0
+
+    def poll(self, latency=FAST, errors=0, timeouts=0, expensive=None):
+        """Runs a poll 10s after the previous one; expensive collectors run
+        when the shedder lets them unless told otherwise"""
+        self.now += 10
+        slowdown = self.shedder.slowdown(self.now)
+        if expensive is None:
+            expensive = 1 if slowdown is not None else 0
+        return self.shedder.update(self.now, latency, errors, timeouts, expensive)
+
+    def open_breaker(self):
+        for i in range(self.shedder.breaker_timeouts):
+            self.poll(timeouts=1)
+        self.assertEqual(self.shedder.mode, SHED_OPEN)
+
+    def wait_for_probe(self):
+        """Polls until the shedder lets the expensive collectors through"""
+        while self.shedder.reopen > self.now + 10:
+            self.poll()
+            self.assertEqual(self.shedder.mode, SHED_OPEN)
+
+    def test_slow_on_latency_and_back_to_normal(self):
+        self.assertFalse(self.poll())
+        for i in range(5):
+            self.poll(latency=SLOW)
+        self.assertEqual(self.shedder.mode, SHED_SLOW)
+        healthy = 0
+        while self.shedder.mode == SHED_SLOW:
+            self.poll()
+            healthy += self.shedder.latency <= self.shedder.slow_latency / 2
+        self.assertEqual(self.shedder.mode, SHED_NORMAL)
+        self.assertEqual(healthy, self.shedder.recovery_polls)
+
+    def test_slow_on_errors(self):
+        self.assertTrue(self.poll(errors=1))
+        self.assertEqual(self.shedder.mode, SHED_SLOW)
+
+    def test_timeouts_reset_by_clean_expensive_poll(self):
+        for i in range(self.shedder.breaker_timeouts - 1):
+            self.poll(timeouts=1)
+        self.poll()
+        self.poll(timeouts=1)
+        self.assertNotEqual(self.shedder.mode, SHED_OPEN)
+
+    def test_open_after_timeouts(self):
+        self.open_breaker()
+        self.assertEqual(self.shedder.delay, self.shedder.breaker_delay)
+        self.poll()
+        self.assertEqual(self.shedder.slowdown(self.now), None)
+        self.assertFalse(self.shedder.probing)
+
+    def test_probe_without_timeouts_goes_slow(self):
+        self.open_breaker()
+        self.wait_for_probe()
+        self.assertTrue(self.poll())
+        self.assertEqual(self.shedder.mode, SHED_SLOW)
+        self.assertEqual(self.shedder.timeouts, 0)
+        # one more timeout does not open the breaker again at once
+        self.poll(timeouts=1)
+        self.assertEqual(self.shedder.mode, SHED_SLOW)
+
+    def test_probe_with_timeouts_doubles_delay(self):
+        self.open_breaker()
+        delays = []
+        for i in range(6):
+            self.wait_for_probe()
+            self.assertFalse(self.poll(timeouts=1))
+            delays.append(self.shedder.delay)
+        self.assertEqual(self.shedder.mode, SHED_OPEN)
+        self.assertEqual(delays, [120.0, 240.0, 480.0, SHED_BREAKER_MAX_DELAY, SHED_BREAKER_MAX_DELAY,
+                                  SHED_BREAKER_MAX_DELAY])
+
+    def test_probe_running_nothing_stays_open(self):
+        self.open_breaker()
+        self.wait_for_probe()
+        self.assertFalse(self.poll(expensive=0))
+        self.assertEqual(self.shedder.mode, SHED_OPEN)
+        self.assertEqual(self.shedder.delay, self.shedder.breaker_delay)
+        self.assertTrue(self.shedder.reopen > self.now)
+
+    def test_delay_kept_when_reopened_from_slow(self):
+        self.open_breaker()
+        self.wait_for_probe()
+        self.poll(timeouts=1)
+        self.wait_for_probe()
+        self.poll()
+        self.assertEqual(self.shedder.mode, SHED_SLOW)
+        self.open_breaker()
+        self.assertEqual(self.shedder.delay, 2 * self.shedder.breaker_delay)
+
+    def test_delay_reset_once_normal(self):
+        self.open_breaker()
+        self.wait_for_probe()
+        self.poll(timeouts=1)
+        self.wait_for_probe()
+        self.poll()
+        for i in range(self.shedder.recovery_polls):
+            self.poll()
+        self.assertEqual(self.shedder.mode, SHED_NORMAL)
+        self.open_breaker()
+        self.assertEqual(self.shedder.delay, self.shedder.breaker_delay)
+
+    def test_disabled(self):
+        self.shedder.enabled = False
+        for i in range(10):
+            self.assertFalse(self.poll(latency=SLOW, errors=1, timeouts=1))
+        self.assertEqual(self.shedder.mode, SHED_NORMAL)
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_forced_run(self):
+        schedule = Schedule({'db_status': 300, 'top': -1})
+        horizon = schedule.start(10)
+        self.assertTrue(schedule.due('db_status', 10, horizon))
+        horizon = schedule.start(20)
+        self.assertFalse(schedule.due('db_status', 20, horizon, 4))
+        self.assertTrue(schedule.due('db_status', 20, horizon, 4, True))
+        self.assertEqual(schedule.next_run['db_status'], 20 + 300 * 4)
+        self.assertFalse(schedule.due('top', 20, horizon, 4, True))
+
+
+if __name__ == '__main__':
+    unittest.main()